@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark mip-analyser.py against a fake MusicIP server
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse, datetime, json, os, random, sqlite3, subprocess, sys, threading, time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FNULL = open(os.devnull, 'w')
+ANALYSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mip-analyser.py')
+GENRES = ['Rock', 'Pop', '13', '(17)', 'Jazz']
+
+
+def info(s):
+    print("[%s] %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), s))
+
+
+def error(s):
+    print("[%s] ERROR: %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), s))
+    exit(-1)
+
+
+class FakeMip:
+    '''
+    State of fake MusicIP server. Files found by server/add are added to MIP's
+    songs, and are then 'analysed' by server/validate. The server reports busy
+    for addLatency seconds per new file when adding, and analysisLatency per
+    file when validating.
+    '''
+    def __init__(self, addLatency, analysisLatency, inactive):
+        self.lock = threading.Lock()
+        self.songs = {}
+        self.pending = []
+        self.busyUntil = 0
+        self.addLatency = addLatency
+        self.analysisLatency = analysisLatency
+        self.inactive = inactive
+        self.requests = {}
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def isBusy(self):
+        return time.time() < self.busyUntil
+
+    def add(self, root):
+        found = 0
+        for dirPath, dirNames, fileNames in os.walk(root, followlinks=True):
+            for name in fileNames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirPath, name)
+                with self.lock:
+                    if not path in self.songs:
+                        self.songs[path] = None
+                        self.pending.append(path)
+                        found += 1
+        self.busyUntil = time.time() + found*self.addLatency
+
+    def validate(self):
+        with self.lock:
+            for path in self.pending:
+                self.songs[path] = random.random() >= self.inactive
+            self.busyUntil = time.time() + len(self.pending)*self.analysisLatency
+            self.pending = []
+
+    def stop(self):
+        self.busyUntil = 0
+
+    def listing(self):
+        with self.lock:
+            songs = list(self.songs.items())
+        for path, active in songs:
+            yield ('file %s\nactive %s\n' % (path, 'no' if active is False else 'yes')).encode()
+
+
+class FakeMipHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, code=200):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mip = self.server.mip
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        mip.count(url.path)
+        if '/api/getStatus' == url.path:
+            self.send(b'busy' if mip.isBusy() else b'idle')
+        elif '/api/songs' == url.path:
+            self.send(b''.join(mip.listing()))
+        elif '/server/add' == url.path:
+            mip.add(params['root'][0])
+            self.send(b'OK')
+        elif '/server/validate' == url.path:
+            if 'Stop Validation' in params.get('action', []):
+                mip.stop()
+            else:
+                mip.validate()
+            self.send(b'OK')
+        else:
+            self.send(b'Not found', 404)
+
+
+def startServer(port, addLatency, analysisLatency, inactive):
+    srv = ThreadingHTTPServer(('localhost', port), FakeMipHandler)
+    srv.mip = FakeMip(addLatency, analysisLatency, inactive)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def ffmpeg(args):
+    if 0 != subprocess.Popen(['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-y'] + args, stdout=FNULL, stderr=subprocess.STDOUT).wait():
+        error("ffmpeg failed : %s" % ' '.join(args))
+
+
+def tone(seconds, index):
+    return ['-f', 'lavfi', '-i', 'sine=frequency=%d:duration=%f' % (220 + (index*37)%880, seconds)]
+
+
+def writeCue(path, audio, titles, length):
+    with open(path, 'w') as f:
+        f.write('FILE "%s" WAVE\n' % os.path.basename(audio))
+        for i, title in enumerate(titles):
+            start = i*length
+            f.write('  TRACK %02d AUDIO\n    TITLE "%s"\n    INDEX 01 %02d:%02d:00\n' % (i+1, title, start//60, start%60))
+
+
+def generate(args):
+    '''
+    Create a synthetic library of m4a, mp3 (some with numeric genres, comments,
+    and images), and flac files - plus flac+CUE albums, and a library.db
+    containing the CUE track details (as LMS would store them).
+    '''
+    music = os.path.join(args.dir, 'Music')
+    os.makedirs(music, exist_ok=True)
+    db = sqlite3.connect(os.path.join(args.dir, 'library.db'))
+    db.execute('create table if not exists tracks (id integer primary key, url text, title text)')
+    formats = args.formats.split(',')
+    random.seed(args.seed)
+    count = 0
+    album = 0
+    while count < args.tracks:
+        album += 1
+        albumDir = os.path.join(music, 'Artist %d' % (album%50), 'Album %d' % album)
+        os.makedirs(albumDir, exist_ok=True)
+        for track in range(args.album_size):
+            fmt = formats[count%len(formats)]
+            path = os.path.join(albumDir, '%02d Track.%s' % (track+1, fmt))
+            cmd = tone(args.duration, count)
+            if 'mp3'==fmt:
+                cmd += ['-metadata', 'genre=%s' % random.choice(GENRES)]
+                if random.random() < 0.3:
+                    cmd += ['-metadata', 'comment=Synthetic']
+            cmd += ['-metadata', 'title=Track %d' % (track+1), path]
+            ffmpeg(cmd)
+            count += 1
+            if count >= args.tracks:
+                break
+        info("Created %d of %d tracks" % (count, args.tracks))
+
+    for cue in range(args.cue_albums):
+        albumDir = os.path.join(music, 'CUE Artist', 'CUE Album %d' % (cue+1))
+        os.makedirs(albumDir, exist_ok=True)
+        audio = os.path.join(albumDir, 'album.flac')
+        ffmpeg(tone(args.duration*args.album_size, cue) + [audio])
+        titles = ['CUE Track %d' % (i+1) for i in range(args.album_size)]
+        writeCue(os.path.join(albumDir, 'album.cue'), audio, titles, int(args.duration))
+        for i, title in enumerate(titles):
+            url = 'file://%s#%d-%d' % (urllib.parse.quote(audio), i*int(args.duration), (i+1)*int(args.duration))
+            db.execute('insert into tracks (url, title) values (?, ?)', (url, title))
+        info("Created %d of %d CUE albums" % (cue+1, args.cue_albums))
+    db.commit()
+    db.close()
+
+
+def peakRss(pid):
+    '''
+    Read peak RSS (in KB) of process. ffmpeg, etc, are separate processes and
+    so are not included.
+    '''
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+def run(args):
+    '''
+    Start the fake MusicIP server, run the analyser against the generated
+    library, and report its throughput, stage times, and peak memory.
+    '''
+    music = os.path.join(args.dir, 'Music')
+    if not os.path.exists(music):
+        error("%s does not exist, use 'generate' first" % music)
+    mip = os.path.join(args.dir, 'MusicIP')
+    os.makedirs(mip, exist_ok=True)
+    srv = startServer(args.port, args.add_latency, args.analysis_latency, args.inactive)
+    config = {'paths':{'lms':music+'/', 'mip':mip+'/', 'lms-remote':music+'/'},
+              'index':os.path.join(args.dir, 'mip-analyser.db'),
+              'mip':{'host':'localhost', 'port':args.port},
+              'poll':args.poll,
+              'threads':args.threads,
+              'batch':args.batch,
+              'pipeline':args.pipeline,
+              'output-format':args.output_format}
+    if os.path.exists(os.path.join(args.dir, 'library.db')):
+        config['lib'] = os.path.join(args.dir, 'library.db')
+    if args.batch_size is not None:
+        config['batch-size'] = args.batch_size
+    if os.path.exists(config['index']):
+        os.remove(config['index'])
+    configPath = os.path.join(args.dir, 'config.json')
+    with open(configPath, 'w') as f:
+        json.dump(config, f)
+
+    results = []
+    for i in range(args.runs):
+        report = os.path.join(args.dir, 'report-%d.json' % (i+1))
+        cmd = [sys.executable, ANALYSER, '-c', configPath, '-r', report]
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=FNULL if not args.verbose else None, stderr=subprocess.STDOUT)
+        peak = 0
+        while proc.poll() is None:
+            peak = max(peak, peakRss(proc.pid))
+            time.sleep(0.1)
+        duration = time.time()-start
+        if not os.path.exists(report):
+            error("Analyser failed, re-run with --verbose for details")
+        with open(report, 'r') as f:
+            res = json.load(f)
+        res['wall'] = duration
+        res['peak_rss_kb'] = peak
+        results.append(res)
+
+        info("Run %d: %d track(s) in %.1fs, %.1f tracks/min, %.1f bytes/s, peak RSS %dKB" %
+             (i+1, res['tracks'], duration, res['tracks_per_min'], res['bytes_per_sec'], res['peak_rss_kb']))
+        for name, stage in res['stages'].items():
+            info("    %-10s %8.2fs (%d calls)" % (name, stage['seconds'], stage['calls']))
+    srv.shutdown()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MusicIP File Analyser Benchmark')
+    sub = parser.add_subparsers(dest='cmd')
+    gen = sub.add_parser('generate', help='Create synthetic music library')
+    gen.add_argument('-d', '--dir', type=str, required=True, help='Folder to create library in')
+    gen.add_argument('-t', '--tracks', type=int, default=200, help='Number of tracks (default: 200)')
+    gen.add_argument('-a', '--album-size', type=int, default=10, help='Tracks per album (default: 10)')
+    gen.add_argument('-c', '--cue-albums', type=int, default=2, help='Number of flac+CUE albums (default: 2)')
+    gen.add_argument('-l', '--duration', type=float, default=30, help='Track length in seconds (default: 30)')
+    gen.add_argument('-f', '--formats', type=str, default='m4a,mp3,flac', help='Formats to create (default: m4a,mp3,flac)')
+    gen.add_argument('-s', '--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    srv = sub.add_parser('serve', help='Only run fake MusicIP server')
+    run_ = sub.add_parser('run', help='Run analyser against fake MusicIP server')
+    for p in [srv, run_]:
+        p.add_argument('-p', '--port', type=int, default=10012, help='Fake MusicIP port (default: 10012)')
+        p.add_argument('--add-latency', type=float, default=0.001, help='Seconds to add each file (default: 0.001)')
+        p.add_argument('--analysis-latency', type=float, default=0.05, help='Seconds to analyse each file (default: 0.05)')
+        p.add_argument('--inactive', type=float, default=0.0, help='Fraction of files that fail analysis (default: 0)')
+    run_.add_argument('-d', '--dir', type=str, required=True, help='Folder containing generated library')
+    run_.add_argument('-n', '--runs', type=int, default=2, help='Number of runs, later runs measure unchanged library (default: 2)')
+    run_.add_argument('--threads', type=int, default=4, help='Analyser transcode threads (default: 4)')
+    run_.add_argument('--batch', type=int, default=50, help='Analyser batch (default: 50)')
+    run_.add_argument('--batch-size', type=str, default=None, help='Analyser batch-size')
+    run_.add_argument('--output-format', type=str, default='mp3', help='Analyser output-format, mp3 or flac (default: mp3)')
+    run_.add_argument('--pipeline', action='store_true', default=False, help='Use analyser pipeline mode')
+    run_.add_argument('--poll', type=float, default=0.1, help='Analyser MIP status poll interval (default: 0.1)')
+    run_.add_argument('-o', '--output', type=str, default=None, help='Write results to JSON file')
+    run_.add_argument('-v', '--verbose', action='store_true', default=False, help='Show analyser output')
+    args = parser.parse_args()
+
+    if 'generate'==args.cmd:
+        generate(args)
+    elif 'run'==args.cmd:
+        run(args)
+    elif 'serve'==args.cmd:
+        startServer(args.port, args.add_latency, args.analysis_latency, args.inactive)
+        info("Fake MusicIP listening on: %d" % args.port)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,19 +7,52 @@
 # GPLv3 license.
 #
 
-import argparse, datetime, json, operator, os, pathlib, signal, sqlite3, subprocess, sys, time
+import argparse, asyncio, collections, contextlib, ctypes, ctypes.util, datetime, errno, hashlib, heapq, json, os, pathlib, select, shutil, signal, sqlite3, struct, subprocess, sys, threading, time
 import urllib.parse
 import urllib.request
 from concurrent.futures import ThreadPoolExecutor
 
 
 FNULL = open(os.devnull, 'w')
-MIP_URL = 'http://localhost:10002/'
+MIP_URL = 'http://%s:%d/'
 AUDIO_EXTENSIONS = ['m4a', 'mp3', 'ogg', 'flac']
-PREV_RUN = '.tracks'
+PREV_RUN = '.tracks' # Only used to import list of files from older versions
+JOB_QUEUED = 'queued'
+JOB_TRANSCODED = 'transcoded'
+JOB_ADDED = 'added'
+JOB_VALIDATED = 'validated'
+JOB_FAILED = 'failed'
+MP3_BYTES_PER_SEC = 128000/8
+FLAC_RATIO = 0.75 # Level 0 FLAC is typically 60-70% of the size of the PCM
+# ffmpeg options for each output format
+OUTPUT_FORMATS = {'mp3':['-b:a', '128k'],
+                  'flac':['-vn', '-c:a', 'flac', '-compression_level', '0', '-sample_fmt', 's16']}
+FILE_OVERHEAD = 4096
+DEFERRED = 'deferred'
+TRANSCODE = 'transcode'
+COPY = 'copy'
+LINK = 'link'
+HASH_CHUNK = 1024*1024
+DUPLICATE_MODES = ['analyse', 'link', 'skip']
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_EVENT = struct.Struct('iIII')
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
 
 config={}
-db=None
+cues={}
+index=None
+journal=None
+dirLock=threading.Lock()
+busyDirs={} # Folders in 'mip' that are being written to, and so must not be removed
+duplicates={} # Track to be transcoded -> tracks with identical audio that will share its transcode
 
 
 def info(s, withNewLine=True):
@@ -37,19 +70,34 @@ def error(s, andExit=True):
 
 should_stop = False # Stop after analysing current
 should_stop_now = False # Stop as qick as possible
+stop_now_event = threading.Event()
+children = set() # PIDs of running ffmpeg processes
+childrenLock = threading.RLock() # Re-entrant, as killChildren is called from the SIGINT handler
 def sigHandler(signum, frame):
     global should_stop
     global should_stop_now
     if should_stop:
         should_stop_now = True
+        stop_now_event.set()
         info(" ")
-        info('Intercepted second CTRL-C, stopping now (might take a few seconds)...')
+        info('Intercepted second CTRL-C, stopping now...')
+        killChildren()
     else:
         should_stop = True
         info(" ")
         info('Intercepted CTRL-C, stopping (will wait for analysis to finish)...')
 
 
+def killChildren():
+    with childrenLock:
+        pids = list(children)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
 def shouldStop():
     global should_stop
     return should_stop
@@ -60,36 +108,145 @@ def shouldStopNow():
     return should_stop_now
 
 
+class Stats:
+    '''
+    Per-stage timings, and counters, for the current run.
+    '''
+    def __init__(self, slowest=10):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.stages = {}
+        self.tracks = 0
+        self.bytes = 0
+        self.slowest = []
+        self.numSlowest = slowest
+        self.duplicates = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.monotonic()-start)
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            if not name in self.stages:
+                self.stages[name] = {'calls':0, 'seconds':0.0}
+            self.stages[name]['calls'] += 1
+            self.stages[name]['seconds'] += seconds
+
+    def addTrack(self, path, count, size, seconds):
+        with self.lock:
+            self.tracks += count
+            self.bytes += size
+            if len(self.slowest)<self.numSlowest:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds>self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def addDuplicates(self, count):
+        with self.lock:
+            self.duplicates += count
+
+    def report(self):
+        with self.lock:
+            duration = time.time()-self.start
+            return {'start':datetime.datetime.fromtimestamp(self.start).isoformat(),
+                    'duration':duration,
+                    'tracks':self.tracks,
+                    'bytes':self.bytes,
+                    'duplicates':self.duplicates,
+                    'tracks_per_min':self.tracks*60.0/duration if duration>0 else 0,
+                    'bytes_per_sec':self.bytes/duration if duration>0 else 0,
+                    'stages':{name:dict(stage) for name, stage in self.stages.items()},
+                    'slowest':[{'path':path, 'seconds':seconds} for seconds, path in sorted(self.slowest, reverse=True)]}
+
+    def writeReport(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def writePrometheus(self, path):
+        '''
+        Write metrics in Prometheus text format, for node_exporter's textfile
+        collector. Written to a temporary file and renamed, so that a partial
+        file is never read.
+        '''
+        report = self.report()
+        lines = ['# TYPE mip_analyser_stage_seconds gauge']
+        for name, stage in report['stages'].items():
+            lines.append('mip_analyser_stage_seconds{stage="%s"} %f' % (name, stage['seconds']))
+        lines.append('# TYPE mip_analyser_stage_calls gauge')
+        for name, stage in report['stages'].items():
+            lines.append('mip_analyser_stage_calls{stage="%s"} %d' % (name, stage['calls']))
+        lines.append('# TYPE mip_analyser_tracks gauge')
+        lines.append('mip_analyser_tracks %d' % report['tracks'])
+        lines.append('# TYPE mip_analyser_bytes gauge')
+        lines.append('mip_analyser_bytes %d' % report['bytes'])
+        lines.append('# TYPE mip_analyser_duplicates gauge')
+        lines.append('mip_analyser_duplicates %d' % report['duplicates'])
+        lines.append('# TYPE mip_analyser_duration_seconds gauge')
+        lines.append('mip_analyser_duration_seconds %f' % report['duration'])
+        lines.append('# TYPE mip_analyser_last_run_timestamp_seconds gauge')
+        lines.append('mip_analyser_last_run_timestamp_seconds %f' % time.time())
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp, path)
+
+
+stats = Stats()
+
+
 def sendMipCommand(path):
-    return urllib.request.urlopen(MIP_URL + path)
+    return urllib.request.urlopen(MIP_URL % (config['mip']['host'], config['mip']['port']) + path)
 
 
 def sendMipApiCommand(path):
-    return urllib.request.urlopen(MIP_URL + 'api/' + path).read().strip()
+    return urllib.request.urlopen(MIP_URL % (config['mip']['host'], config['mip']['port']) + 'api/' + path).read().strip()
 
 
-def cueTracks(path):
+def readCueTracks(path):
     '''
-    Query LMS db to get the list of tracks in a queue file with their start and
-    stop end times
+    Read the details of all CUE tracks from LMS's db. LMS stores these as
+    file:///path/file.flac#start-end, so read all such URLs in one query and
+    store these in a map of source path to list of tracks. The db is opened
+    read-only so as to not lock a running LMS.
     '''
-    global config
-    global db
-    tracks=[]
-    for lms_path in ['lms', 'lms-remote']:
-        src = os.path.join(config['paths'][lms_path], path)
-        cursor = db.execute("select url, title from tracks where url like '%%%s#%%'" % urllib.parse.quote(src))
-        for row in cursor:
+    tracks={}
+    conn = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(path), uri=True)
+    try:
+        for row in conn.execute("select url, title from tracks where url like '%#%'"):
             parts=row[0].split('#')
             if 2==len(parts):
                 times=parts[1].split('-')
                 if 2==len(times):
-                    tracks.append({'file':path, 'start':times[0], 'end':times[1], 'title':row[1]})
-        if len(tracks)>0:
-            return tracks
+                    src=urllib.parse.unquote(parts[0][7:] if parts[0].startswith('file://') else parts[0])
+                    if not src in tracks:
+                        tracks[src]=[]
+                    tracks[src].append({'start':times[0], 'end':times[1], 'title':row[1]})
+    finally:
+        conn.close()
+    for src in tracks:
+        tracks[src].sort(key=lambda t: float(t['start']))
     return tracks
 
 
+def cueTracks(path):
+    '''
+    Get the list of tracks in a cue file with their start and stop end times
+    '''
+    global config
+    global cues
+    for lms_path in ['lms', 'lms-remote']:
+        if lms_path in config['paths']:
+            src = os.path.join(config['paths'][lms_path], path)
+            if src in cues:
+                return [dict(track, file=path) for track in cues[src]]
+    return []
+
+
 def createDir(d):
     if not os.path.exists(d):
         try:
@@ -100,34 +257,99 @@ def createDir(d):
 
 def doCommand(cmd):
     #info("COMMAND: %s" % str(cmd))
-    subprocess.Popen(cmd, stdout=FNULL, stderr=subprocess.STDOUT).wait()
+    proc = subprocess.Popen(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
+    with childrenLock:
+        children.add(proc.pid)
+    try:
+        proc.wait()
+    finally:
+        with childrenLock:
+            children.discard(proc.pid)
+
+
+async def doCommandAsync(cmd):
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    with childrenLock:
+        children.add(proc.pid)
+    try:
+        await proc.wait()
+    finally:
+        with childrenLock:
+            children.discard(proc.pid)
+
+
+def mp3TagIssues(path):
+    '''
+    Read ID3v2 tag of an MP3 and return the set of issues MIP has with it -
+    'genre' if it has a numeric genre, 'tags' if it has comments, lyrics, or
+    images. 'error' is returned if the tag cannot be parsed.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read(10)
+        if len(data)<10 or data[:3]!=b'ID3':
+            return set()
+        data += f.read(fromSyncsafe(data[6:10]) + (10 if 4==data[3] and data[5]&0x10 else 0))
+    version, frames, tagLen = readId3(data)
+    if version is None:
+        return set(['error'])
+    issues = set()
+    for frameId, flags, body in frames:
+        if frameId in ID3_REMOVE_FRAMES[version]:
+            issues.add('tags')
+        elif frameId == ID3_GENRE_FRAME[version] and len(body)>1:
+            try:
+                text = body[1:].decode(ID3_ENCODINGS[body[0]])
+            except Exception:
+                continue
+            for genre in text.split('\x00'):
+                genre = genre.strip()
+                if genre.startswith('('):
+                    genre = genre[1:].split(')', 1)[0]
+                if len(genre)>0 and genre.isdigit():
+                    issues.add('genre')
+    return issues
 
 
 def shouldTranscode(path):
     '''
-    Determine if a track needs to be transcoded. Currently all are, but in
-    future should check if MP3 has embedded cover or numeric genre.
+    Determine if, and how, a track needs to be converted. Non-MP3s are always
+    transcoded, as are MP3s with numeric genres (ffmpeg will convert these to
+    the genre name). MP3s with comments, lyrics, or images are copied (and then
+    have these tags stripped), all others are symlinked.
     '''
-    return True
-    # TODO: Improve this check to also check for images? Seems like MIP does not like some embedded images...
-    #if path.endswith(".mp3"):
-    #    for line in subprocess.check_output(["eyeD3", "--non-std-genres", path], stderr=subprocess.STDOUT).splitlines():
-    #        l=str(line)
-    #        if "WARNING: Non standard genre name:" in l:
-    #            try:
-    #                genre=int(l.split(":")[-1:][0].replace("'", "").strip())
-    #                return True
-    #            except Exception as e:
-    #                # Genre is text, so does not need transcoding
-    #                return False
-    #                pass
-    #    return False
-    #return True
-
-                    
+    if not path.endswith('.mp3'):
+        return TRANSCODE
+    issues = mp3TagIssues(path)
+    if 'genre' in issues or 'error' in issues:
+        return TRANSCODE
+    return COPY if 'tags' in issues else LINK
+
+
+def outputArgs():
+    '''
+    Get ffmpeg options for 'output-format', with optional downmix and resample.
+    '''
+    global config
+    args = list(OUTPUT_FORMATS[config['output-format']])
+    if config['output-channels'] is not None:
+        args += ['-ac', str(config['output-channels'])]
+    if config['output-rate'] is not None:
+        args += ['-ar', str(config['output-rate'])]
+    return args
+
+
+def outputBytesPerSec():
+    global config
+    if 'mp3'==config['output-format']:
+        return MP3_BYTES_PER_SEC
+    channels = config['output-channels'] if config['output-channels'] is not None else 2
+    rate = config['output-rate'] if config['output-rate'] is not None else 44100
+    return rate*channels*2*FLAC_RATIO
+
+
 def buildCommand(track):
     '''
-    Build command to transcode a track to MP3
+    Build command to transcode a track to 'output-format'
     '''
     global config
     dest=os.path.join(config['paths']['mip'], track)
@@ -138,40 +360,81 @@ def buildCommand(track):
             os.symlink(src, dest)
         return None, dest
 
-    # For m4a, opus, etc, we need to transcode to mp3 - so we'll use .m4a.mp3, etc.
+    # For m4a, opus, etc, we need to transcode - so we'll use .m4a.mp3 (or
+    # .m4a.flac), etc. MP3s that need fixing are always re-encoded to MP3.
     if not dest.endswith('.mp3'):
-        dest+='.mp3'
+        dest+='.'+config['output-format']
     if os.path.exists(dest):
         return None, dest
-    if shouldTranscode(src):
+    if not src.endswith('.mp3'):
+        return ['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-i', src] + outputArgs() + [dest], dest
+    action = shouldTranscode(src)
+    if TRANSCODE == action:
         return ['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-i', src, '-b:a', '128k', dest], dest
-    os.symlink(src, dest)
+    if COPY == action:
+        shutil.copyfile(src, dest)
+    else:
+        os.symlink(src, dest)
     return None, dest
 
 
-def buildCueCommand(track):
+def cueTrackPath(track):
+    global config
+    return '%s.CUE_TRACK.%s-%s.%s' % (track['file'], track['start'], track['end'], config['output-format'])
+
+
+def mipSongPath(path):
     '''
-    Build command to extract track from CUE
+    Convert path of a song in MIP to that of the file that it was transcoded
+    from. Only songs transcoded to the current 'output-format' are converted,
+    as the proxy will only ask MIP for these. Songs transcoded to another
+    format will then not match any file - so the file is re-analysed, and the
+    song is listed as needing to be removed from MIP.
     '''
     global config
-    src = os.path.join(config['paths']['lms'], track['file'])
-    dest = os.path.join(config['paths']['mip'], '%s.CUE_TRACK.%s-%s.mp3' % (track['file'], track['start'], track['end']))
-    if os.path.exists(dest):
-        return None, dest
-    end = float(track['end'])-float(track['start'])
-    return ['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-i', src, '-b:a', '128k', '-ss', track['start'], '-t', "%f" % end, dest], dest
+    if path.endswith('.m4a.'+config['output-format']):
+        return path[:-(len(config['output-format'])+1)]
+    return path
+
+
+def buildCueCommand(group):
+    '''
+    Build command to extract tracks from CUE. All tracks are extracted with a
+    single ffmpeg invocation (one output per track) so that the source file is
+    only decoded once.
+    '''
+    global config
+    src = os.path.join(config['paths']['lms'], group['file'])
+    outputs = []
+    dests = []
+    for track in group['tracks']:
+        dest = os.path.join(config['paths']['mip'], cueTrackPath(track))
+        dests.append(dest)
+        if os.path.exists(dest):
+            continue
+        end = float(track['end'])-float(track['start'])
+        if 'mp3'==config['output-format']:
+            outputs += ['-b:a', '128k', '-ss', track['start'], '-t', "%f" % end, dest]
+        else:
+            # Title is set by setCueTrackTitle for MP3s
+            outputs += outputArgs() + ['-metadata', 'title=%s' % track['title'], '-ss', track['start'], '-t', "%f" % end, dest]
+    if len(outputs)==0:
+        return None, dests
+    return ['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-i', src] + outputs, dests
 
 
 def setCueTrackTitle(track):
     global config
-    dest = os.path.join(config['paths']['mip'], '%s.CUE_TRACK.%s-%s.mp3' % (track['file'], track['start'], track['end']))
-    if os.path.exists(dest):
-        doCommand(['eyeD3', '-t', track['title'], '--remove-all-comments', '--remove-all-lyrics', '--remove-all-images', '--max-padding', '1', dest])
+    dest = os.path.join(config['paths']['mip'], cueTrackPath(track))
+    if dest.endswith('.mp3') and os.path.exists(dest):
+        with stats.stage('tags'):
+            rewriteTags(dest, track['title'])
 
 
-def transcode(track):
+def prepareTranscode(track):
     '''
-    Transcode track as required
+    Create destination folder, and mark as in use, and get the command required
+    to transcode track (or group of CUE tracks).
     '''
     global config
     isCue = isinstance(track, dict)
@@ -179,16 +442,170 @@ def transcode(track):
 
     #info('...transcoding %s' % path)
     destDir = os.path.join(config['paths']['mip'], os.path.dirname(path))
-    createDir(destDir)
+    with dirLock:
+        busyDirs[destDir] = busyDirs.get(destDir, 0) + 1
+        createDir(destDir)
+
+    try:
+        command, dest = buildCueCommand(track) if isCue else buildCommand(track)
+    except:
+        releaseDir(destDir)
+        raise
+    return destDir, command, dest
+
+
+def releaseDir(destDir):
+    with dirLock:
+        busyDirs[destDir] -= 1
+        if 0 == busyDirs[destDir]:
+            del busyDirs[destDir]
+
+
+def finishTranscode(track, destDir):
+    try:
+        if isinstance(track, dict):
+            for cueTrack in track['tracks']:
+                setCueTrackTitle(cueTrack)
+    finally:
+        releaseDir(destDir)
+
 
-    command, dest = buildCueCommand(track) if isCue else buildCommand(track)
-    if command:
-        doCommand(command)
-    if isCue:
-        setCueTrackTitle(track)
+def transcode(track):
+    '''
+    Transcode track (or group of CUE tracks) as required
+    '''
+    destDir, command, dest = prepareTranscode(track)
+    try:
+        if command:
+            with stats.stage('transcode'):
+                doCommand(command)
+    finally:
+        finishTranscode(track, destDir)
+    return dest
+
+
+async def transcodeAsync(track):
+    destDir, command, dest = await asyncio.to_thread(prepareTranscode, track)
+    try:
+        if command:
+            with stats.stage('transcode'):
+                await doCommandAsync(command)
+    finally:
+        await asyncio.to_thread(finishTranscode, track, destDir)
     return dest
 
 
+ID3_REMOVE_FRAMES = {2:[b'COM', b'ULT', b'PIC'], 3:[b'COMM', b'USLT', b'APIC'], 4:[b'COMM', b'USLT', b'APIC']}
+ID3_TITLE_FRAME = {2:b'TT2', 3:b'TIT2', 4:b'TIT2'}
+ID3_GENRE_FRAME = {2:b'TCO', 3:b'TCON', 4:b'TCON'}
+ID3_ENCODINGS = {0:'latin-1', 1:'utf-16', 2:'utf-16-be', 3:'utf-8'}
+
+
+def fromSyncsafe(data):
+    val = 0
+    for b in data:
+        val = (val<<7) | (b & 0x7f)
+    return val
+
+
+def toSyncsafe(val, length=4):
+    return bytes([(val >> (7*(length-1-i))) & 0x7f for i in range(length)])
+
+
+def readId3Frames(version, body, syncsafe):
+    '''
+    Split ID3v2 tag body into list of (id, flags, data). Returns None if the
+    frames cannot be parsed.
+    '''
+    frames = []
+    idLen, hdrLen = (3, 6) if 2==version else (4, 10)
+    pos = 0
+    while pos+hdrLen <= len(body):
+        frameId = body[pos:pos+idLen]
+        if frameId[0]==0:
+            break # Padding
+        if not all(c in b'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' for c in frameId):
+            return None
+        if 2==version:
+            size = int.from_bytes(body[pos+3:pos+6], 'big')
+            flags = b''
+        else:
+            size = fromSyncsafe(body[pos+4:pos+8]) if syncsafe else int.from_bytes(body[pos+4:pos+8], 'big')
+            flags = body[pos+8:pos+10]
+        if pos+hdrLen+size > len(body):
+            return None
+        frames.append((frameId, flags, body[pos+hdrLen:pos+hdrLen+size]))
+        pos += hdrLen+size
+    return frames
+
+
+def readId3(data):
+    '''
+    Parse ID3v2 tag at start of data. Returns (version, frames, tagLen), version
+    is None if there is no tag, or it is not understood.
+    '''
+    if len(data)<10 or data[:3]!=b'ID3' or not data[3] in ID3_REMOVE_FRAMES:
+        return None, [], 0
+    version = data[3]
+    flags = data[5]
+    size = fromSyncsafe(data[6:10])
+    tagLen = 10 + size + (10 if 4==version and flags&0x10 else 0)
+    body = data[10:10+size]
+    if 2==version and flags&0x40:
+        return None, [], 0 # Compressed
+    if flags&0x80 and version<4:
+        body = body.replace(b'\xff\x00', b'\xff')
+    if flags&0x40:
+        # Skip extended header
+        body = body[4+int.from_bytes(body[:4], 'big'):] if 3==version else body[fromSyncsafe(body[:4]):]
+    frames = readId3Frames(version, body, 4==version)
+    if frames is None and 4==version:
+        # Some taggers incorrectly write v2.3 style frame sizes in v2.4 tags
+        frames = readId3Frames(version, body, False)
+    if frames is None:
+        return None, [], 0
+    return version, frames, tagLen
+
+
+def writeId3(version, frames):
+    body = []
+    for frameId, flags, data in frames:
+        if 2==version:
+            body.append(frameId + len(data).to_bytes(3, 'big'))
+        else:
+            body.append(frameId + (toSyncsafe(len(data)) if 4==version else len(data).to_bytes(4, 'big')) + flags)
+        body.append(data)
+    body = b''.join(body)
+    return b'ID3' + bytes([version, 0, 0]) + toSyncsafe(len(body)) + body
+
+
+def rewriteTags(path, title=None):
+    '''
+    Remove comments, lyrics, and images from an MP3's ID3v2 tag - and
+    optionally set its title. The tag is written with no padding.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    version, frames, tagLen = readId3(data)
+    if version is None:
+        if data[:3]==b'ID3' or title is None:
+            return
+        version = 4
+    remove = ID3_REMOVE_FRAMES[version] + ([ID3_TITLE_FRAME[version]] if title is not None else [])
+    frames = [frame for frame in frames if not frame[0] in remove]
+    if title is not None:
+        text = b'\x03' + title.encode('utf-8') if 4==version else b'\x01' + title.encode('utf-16')
+        frames.insert(0, (ID3_TITLE_FRAME[version], b'' if 2==version else b'\x00\x00', text))
+    tag = writeId3(version, frames)
+    if tag == data[:tagLen]:
+        return
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(tag)
+        f.write(data[tagLen:])
+    os.replace(temp, path)
+
+
 def stripTags(file):
     '''
     Strip comments, lyrics, and images from MP3s. MIP seems to have issues with
@@ -196,7 +613,8 @@ def stripTags(file):
     '''
     if not os.path.islink(file) and file.endswith(".mp3"):
         #info("...stripping tags from %s" % file)
-        doCommand(["eyeD3", "--remove-all-comments", "--remove-all-lyrics", "--remove-all-images", "--max-padding", "1", file])
+        with stats.stage('tags'):
+            rewriteTags(file)
 
 
 def write(s):
@@ -210,8 +628,8 @@ def waitForIdle():
     '''
     while True:
         write('.')
-        time.sleep(5)
-        status=sendMipApiCommand('getStatus')
+        stop_now_event.wait(config['poll'])
+        status=sendMipApiCommand('getStatus') if not shouldStopNow() else None
         if b'idle' == status:
             write('\n')
             return True
@@ -220,189 +638,1175 @@ def waitForIdle():
             return False
 
 
-def getMipSongs():
+def readMipSongs():
+    '''
+    Read MIP's extended songs listing line by line, as it is received, and
+    yield (path, active) for each song. Paths are relative to 'mip'.
+    '''
     global config
-    lines=sendMipApiCommand('songs?extended').splitlines()
     mipLen = len(config['paths']['mip'])
-    songs = []
-    inactiveSongs = []
     path = None
-    for line in lines:
-        line=line.decode()
-        if line.startswith('file '):
-            path = line[5:]
-            if path.startswith(config['paths']['mip']):
-                path = path[mipLen:]
-            if path.endswith('.m4a.mp3'):
-                path = path[:-4]
-        elif line.startswith('active '):
-            if path is not None:
-                if line.startswith('active no'):
-                    inactiveSongs.append(path)
-                songs.append(path)
-                path = None
-    return set(songs), set(inactiveSongs)
-
-
-def getFiles(path, files):
-    if not os.path.exists(path):
-        error("'%s' does not exist" % path)
-        return
-    if os.path.isdir(path):
-        for e in sorted(os.listdir(path)):
-            getFiles(os.path.join(path, e), files)
-    elif path.rsplit('.', 1)[1].lower() in AUDIO_EXTENSIONS:
-        mipLen = len(config['paths']['mip'])
-        if os.path.exists(path.rsplit('.', 1)[0]+'.cue'):
-            for track in cueTracks(path[mipLen:]):
-                files.append(track)
+    with sendMipCommand('api/songs?extended') as resp:
+        for line in resp:
+            line=line.decode().strip()
+            if line.startswith('file '):
+                path = line[5:]
+                if path.startswith(config['paths']['mip']):
+                    path = path[mipLen:]
+                path = mipSongPath(path)
+            elif line.startswith('active '):
+                if path is not None:
+                    yield path, not line.startswith('active no')
+                    path = None
+
+
+def getMipSongs():
+    songs = set()
+    inactiveSongs = set()
+    for path, active in readMipSongs():
+        songs.add(path)
+        if not active:
+            inactiveSongs.add(path)
+    return songs, inactiveSongs
+
+
+def openIndex(path):
+    '''
+    Open (creating if required) the scan index. This holds the details of each
+    audio file, and the modification time of each folder, found in the last
+    scan of 'lms'.
+    '''
+    conn = sqlite3.connect(path)
+    conn.execute('create table if not exists meta (key text primary key, value text)')
+    conn.execute('create table if not exists dirs (path text primary key, parent text, mtime integer)')
+    conn.execute('create table if not exists files (path text primary key, dir text, size integer, mtime integer, inode integer, cue integer)')
+    conn.execute('create index if not exists dirs_parent on dirs(parent)')
+    conn.execute('create index if not exists files_dir on files(dir)')
+    conn.execute('create table if not exists reanalyse (path text primary key, attempts integer, last integer)')
+    conn.execute('create table if not exists hashes (path text primary key, size integer, mtime integer, hash text)')
+    conn.execute('create index if not exists hashes_hash on hashes(hash)')
+    row = conn.execute("select value from meta where key='root'").fetchone()
+    if row is None or row[0]!=config['paths']['lms']:
+        # Paths are relative to 'lms', so if this has changed then index is useless
+        conn.execute('delete from dirs')
+        conn.execute('delete from files')
+        conn.execute('delete from hashes')
+        conn.execute("insert or replace into meta (key, value) values ('root', ?)", (config['paths']['lms'],))
+        conn.commit()
+    return conn
+
+
+def inactiveTrack(path):
+    '''
+    Convert path of an inactive MIP song into a track (or CUE track) that can
+    be transcoded. Returns None if the source no longer exists.
+    '''
+    global config
+    if '.CUE_TRACK.' in path:
+        parts = path.rsplit('.', 1)[0].split('.CUE_TRACK.')
+        times = parts[1].split('-')
+        if 2!=len(parts) or 2!=len(times):
+            return None
+        for track in cueTracks(parts[0]):
+            if track['start']==times[0] and track['end']==times[1]:
+                return track
+        return None
+    return path if os.path.exists(os.path.join(config['paths']['lms'], path)) else None
+
+
+def selectInactive(inactiveSongs):
+    '''
+    Select the inactive songs to re-analyse. The number of attempts for each
+    song is recorded in the index, and songs are skipped once they have failed
+    'reanalyse-attempts' times. At most 'reanalyse-limit' songs are selected.
+    Returns list of tracks to re-analyse, and list of paths skipped.
+    '''
+    global config
+    global index
+    # Songs that are no longer inactive have been re-analysed
+    for row in index.execute("select path from reanalyse").fetchall():
+        if not row[0] in inactiveSongs:
+            index.execute("delete from reanalyse where path=?", (row[0],))
+
+    tracks = []
+    skipped = []
+    now = int(time.time())
+    for path in sorted(inactiveSongs):
+        row = index.execute("select attempts from reanalyse where path=?", (path,)).fetchone()
+        attempts = 0 if row is None else row[0]
+        if attempts<config['reanalyse-attempts'] and len(tracks)>=config['reanalyse-limit']:
+            continue # Leave for next run
+        track = None if attempts>=config['reanalyse-attempts'] else inactiveTrack(path)
+        if track is None:
+            skipped.append(path)
+            continue
+        tracks.append(track)
+        index.execute("insert or replace into reanalyse (path, attempts, last) values (?, ?, ?)", (path, attempts+1, now))
+    index.commit()
+    return tracks, skipped
+
+
+def removeIndexDir(path, changes):
+    '''
+    Remove folder, and all within, from the index. An exact prefix test is used,
+    as 'like' would treat '_' and '%' as wildcards, and ignores case.
+    '''
+    global index
+    prefix = (len(path)+1, path+'/')
+    for row in index.execute("select path from files where dir=? or substr(dir, 1, ?)=?", (path,) + prefix):
+        changes['deleted'].append(row[0])
+    index.execute("delete from files where dir=? or substr(dir, 1, ?)=?", (path,) + prefix)
+    index.execute("delete from hashes where substr(path, 1, ?)=?", prefix)
+    index.execute("delete from dirs where path=? or substr(path, 1, ?)=?", (path,) + prefix)
+
+
+def scanDir(path, changes, fullRescan):
+    '''
+    Scan a folder (path is relative to 'lms'). If the folder's modification time
+    matches that stored in the index then its list of files, and sub-folders,
+    is read from the index - otherwise the folder is read from disk and the
+    index updated.
+    '''
+    global config
+    global index
+    absPath = os.path.join(config['paths']['lms'], path)
+    mtime = os.stat(absPath).st_mtime_ns
+    row = index.execute("select mtime from dirs where path=?", (path,)).fetchone()
+    entries = []
+    if not fullRescan and row is not None and row[0]==mtime:
+        for row in index.execute("select path, cue from files where dir=?", (path,)):
+            entries.append((os.path.basename(row[0]), False, row[1]))
+        for row in index.execute("select path from dirs where parent=?", (path,)):
+            entries.append((os.path.basename(row[0]), True, False))
+    else:
+        known = {}
+        for row in index.execute("select path, size, mtime, inode, cue from files where dir=?", (path,)):
+            known[row[0]] = row[1:]
+        knownDirs = set()
+        for row in index.execute("select path from dirs where parent=?", (path,)):
+            knownDirs.add(row[0])
+
+        with os.scandir(absPath) as it:
+            dirEntries = list(it)
+        names = set([e.name for e in dirEntries])
+        for e in dirEntries:
+            filePath = os.path.join(path, e.name)
+            if e.is_dir():
+                entries.append((e.name, True, False))
+                knownDirs.discard(filePath)
+            else:
+                parts = e.name.rsplit('.', 1)
+                if len(parts)<2 or not parts[1].lower() in AUDIO_EXTENSIONS:
+                    continue
+                isCue = (parts[0]+'.cue') in names
+                try:
+                    st = e.stat()
+                except OSError as ex:
+                    # e.g. broken symlink
+                    info("Skipping %s : %s" % (filePath, str(ex)))
+                    continue
+                entries.append((e.name, False, isCue))
+                details = (st.st_size, st.st_mtime_ns, st.st_ino)
+                prev = known.pop(filePath, None)
+                if prev is None:
+                    changes['new'].append(filePath)
+                elif tuple(prev[:3])!=details:
+                    changes['changed'].append(filePath)
+                elif prev[3]==(1 if isCue else 0):
+                    continue
+                # else only a .cue has been added, or removed, so just update the index
+                index.execute("insert or replace into files (path, dir, size, mtime, inode, cue) values (?, ?, ?, ?, ?, ?)",
+                              (filePath, path) + details + (1 if isCue else 0,))
+
+        for filePath in known:
+            changes['deleted'].append(filePath)
+            index.execute("delete from files where path=?", (filePath,))
+            index.execute("delete from hashes where path=?", (filePath,))
+        for dirPath in knownDirs:
+            removeIndexDir(dirPath, changes)
+        index.execute("insert or replace into dirs (path, parent, mtime) values (?, ?, ?)", (path, os.path.dirname(path) if len(path)>0 else None, mtime))
+
+    for name, isDir, isCue in sorted(entries):
+        if isDir:
+            yield from scanDir(os.path.join(path, name), changes, fullRescan)
+        elif isCue:
+            yield from cueTracks(os.path.join(path, name))
         else:
-            files.append(path[mipLen:])
+            yield os.path.join(path, name)
+
+
+def getFiles(changes, fullRescan):
+    '''
+    Yield audio files (or CUE tracks) in 'lms'. The paths of files that are
+    new, changed, or deleted since the last scan are added to changes.
+    '''
+    global config
+    global index
+    if not os.path.exists(config['paths']['lms']):
+        error("'%s' does not exist" % config['paths']['lms'])
+    yield from scanDir('', changes, fullRescan)
+    index.commit()
 
 
 def check(mipSongs, files):
+    '''
+    Compare MIP's songs against files, as these are read. Returns list of files
+    (or CUE tracks) to add, and list of MIP paths to remove. Songs that are
+    found are removed from mipSongs, so that on return it only contains those
+    that are no longer present.
+    '''
     toAdd = []
-    toRemove = []
-    lmsFiles = []
     for file in files:
-        path = '%s.CUE_TRACK.%s-%s.mp3' % (file['file'], file['start'], file['end']) if isinstance(file, dict) else file
+        path = cueTrackPath(file) if isinstance(file, dict) else file
 
-        if not path in mipSongs:
-            toAdd.append(path)
-        lmsFiles.append(path)
-
-    lmsSet = set(lmsFiles)
-    for song in mipSongs:
-        if not song in lmsSet:
-            toRemove.append(song)
+        if path in mipSongs:
+            mipSongs.discard(path)
+        else:
+            toAdd.append(file)
 
-    return sorted(toAdd), sorted(toRemove)
+    toRemove = list(mipSongs)
+    toRemove.sort()
+    return toAdd, toRemove
 
 
 def removeTranscode(path):
     global config
     info("Cleanup %s" % path)
+    with stats.stage('cleanup'):
+        doRemoveTranscode(path)
 
-    if os.path.exists(path):
+
+def doRemoveTranscode(path):
+    global config
+
+    if os.path.lexists(path):
         os.remove(path)
 
     directory = os.path.dirname(path)
-    while directory.startswith(config['paths']['mip']) and abs(len(directory)-len(config['paths']['mip']))>1:
-        if os.path.exists(directory) and 0 == len(os.listdir(directory)):
-            os.rmdir(directory)
-            directory = os.path.dirname(directory)
-        else:
-            return
-
+    with dirLock:
+        while directory.startswith(config['paths']['mip']) and abs(len(directory)-len(config['paths']['mip']))>1:
+            if not directory in busyDirs and os.path.exists(directory) and 0 == len(os.listdir(directory)):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+            else:
+                return
 
-def readPrevious():
-    prev = []
 
+def destPaths(track):
+    '''
+    Get path(s) in 'mip' that a track (CUE track, or group of CUE tracks) will
+    be transcoded, or linked, to.
+    '''
     global config
-    try:
-        with open(os.path.join(config['paths']['mip'], PREV_RUN), 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        return []
+    if isinstance(track, dict):
+        return [os.path.join(config['paths']['mip'], cueTrackPath(t)) for t in (track['tracks'] if 'tracks' in track else [track])]
+    dests = []
+    for path in [track] + duplicates.get(track, []):
+        dest = os.path.join(config['paths']['mip'], path)
+        dests.append(dest if dest.endswith('.mp3') or dest.endswith('.ogg') or dest.endswith('.flac') else dest+'.'+config['output-format'])
+    return dests
 
 
-def savePrevious(prev):
-    global config
-    with open(os.path.join(config['paths']['mip'], PREV_RUN), 'w') as f:
-        json.dump(prev, f)
+class Journal:
+    '''
+    Record of the state of each track being analysed, keyed on its path in
+    'mip'. Tracks are queued, transcoded, added (to MIP), and validated - after
+    which they are removed from 'mip' and the journal. Stored in SQLite (WAL
+    mode), and updated as each track changes state, so that if the analyser is
+    stopped or killed it can carry on from where it was.
+    '''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        self.conn.execute('create table if not exists jobs (dest text primary key, track text, state text, updated integer, error text)')
+        self.conn.commit()
+
+    def queue(self, tracks):
+        now = int(time.time())
+        with self.lock:
+            for track in tracks:
+                self.conn.executemany('insert or replace into jobs (dest, track, state, updated, error) values (?, ?, ?, ?, null)',
+                                      [(dest, json.dumps(track), JOB_QUEUED, now) for dest in destPaths(track)])
+            self.conn.commit()
+
+    def setState(self, dests, state, err=None):
+        now = int(time.time())
+        with self.lock:
+            self.conn.executemany('update jobs set state=?, updated=?, error=? where dest=?', [(state, now, err, dest) for dest in dests])
+            self.conn.commit()
+
+    def remove(self, dests):
+        with self.lock:
+            self.conn.executemany('delete from jobs where dest=?', [(dest,) for dest in dests])
+            self.conn.commit()
+
+    def resume(self):
+        '''
+        Tidy up after previous run. Validated tracks are removed, tracks that were
+        transcoded (or added) and are still in 'mip' are returned so that they
+        can be analysed, and anything else in 'mip' is removed - as this will be
+        a partial transcode, or an orphan. Failed tracks are left in the journal
+        for reference.
+        '''
+        global config
+        # Import list of files from older versions
+        prevRun = os.path.join(config['paths']['mip'], PREV_RUN)
+        if os.path.exists(prevRun):
+            try:
+                with open(prevRun, 'r') as f:
+                    now = int(time.time())
+                    with self.lock:
+                        self.conn.executemany('insert or ignore into jobs (dest, track, state, updated, error) values (?, null, ?, ?, null)',
+                                              [(dest, JOB_TRANSCODED, now) for dest in json.load(f)])
+                        self.conn.commit()
+            except Exception as e:
+                pass
+            os.remove(prevRun)
+
+        with self.lock:
+            rows = self.conn.execute('select dest, state from jobs').fetchall()
+        toAnalyse = []
+        finished = []
+        for dest, state in rows:
+            if state in [JOB_TRANSCODED, JOB_ADDED] and os.path.lexists(dest):
+                toAnalyse.append(dest)
+            elif JOB_FAILED != state:
+                finished.append(dest)
+        self.remove(finished)
+
+        keep = set(toAnalyse)
+        for dirPath, dirNames, fileNames in os.walk(config['paths']['mip']):
+            for name in fileNames:
+                path = os.path.join(dirPath, name)
+                if not path in keep:
+                    removeTranscode(path)
+        return toAnalyse
+
+
+def addToMip():
+    info("Add path to MIP", False)
+    with stats.stage('add'):
+        sendMipCommand('server/add?root=%s' % config['paths']['mip']).read()
+        return waitForIdle()
 
 
-def removePrevious():
-    global config
-    path = os.path.join(config['paths']['mip'], PREV_RUN)
-    if os.path.exists(path):
-        os.remove(path)
+def validateInMip():
+    info("Analysing", False)
+    with stats.stage('validate'):
+        sendMipCommand('server/validate?action=Start+Validation')
+        if not waitForIdle():
+            sendMipCommand('server/validate?action=Stop+Validation')
+            return False
+    return True
 
 
 def doAnalysis(tempToRemove):
     try:
-        info("Add path to MIP", False)
-        sendMipCommand('server/add?root=%s' % config['paths']['mip']).read()
-        if not waitForIdle():
-            savePrevious(tempToRemove)
+        if not addToMip():
             return False
-
-        info("Analysing", False)
-        sendMipCommand('server/validate?action=Start+Validation')
-        if not waitForIdle():
-            sendMipCommand('server/validate?action=Stop+Validation')
-            savePrevious(tempToRemove)
+        journal.setState(tempToRemove, JOB_ADDED)
+        if not validateInMip():
             return False
+        journal.setState(tempToRemove, JOB_VALIDATED)
 
     except Exception as e:
         error("MIP is no longer running? %s" % str(e), False)
-        savePrevious(tempToRemove)
         return False
 
     for temp in tempToRemove:
         removeTranscode(temp)
-    removePrevious()
+    journal.remove(tempToRemove)
 
     return False if shouldStop() else True
 
 
-def processTrack(track, current, total):
+def trackCount(track):
+    if isinstance(track, dict):
+        return len(track['tracks'])
+    return 1+len(duplicates.get(track, []))
+
+
+def groupCueTracks(tracks):
+    '''
+    Group CUE tracks by their source file, so that each source is only
+    decoded once.
+    '''
+    items = []
+    groups = {}
+    for track in tracks:
+        if isinstance(track, dict):
+            if track['file'] in groups:
+                groups[track['file']]['tracks'].append(track)
+            else:
+                groups[track['file']] = {'file':track['file'], 'tracks':[track]}
+                items.append(groups[track['file']])
+        else:
+            items.append(track)
+    return items
+
+
+def parseSize(val):
+    '''
+    Convert a size (e.g. 750M) to bytes
+    '''
+    if isinstance(val, int):
+        return val
+    val = str(val).strip().upper()
+    for suffix, mult in [('K', 1024), ('M', 1024*1024), ('G', 1024*1024*1024)]:
+        if val.endswith(suffix):
+            return int(float(val[:-1])*mult)
+    return int(val)
+
+
+def freeSpace():
+    global config
+    st = os.statvfs(config['paths']['mip'])
+    return st.f_bavail * st.f_frsize
+
+
+def m4aDuration(path):
+    '''
+    Read duration (in seconds) from an m4a's mvhd atom, returns None if this
+    cannot be found.
+    '''
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        pos = 0
+        while pos+8 <= end:
+            f.seek(pos)
+            header = f.read(8)
+            size = int.from_bytes(header[:4], 'big')
+            hdrLen = 8
+            if 1==size:
+                size = int.from_bytes(f.read(8), 'big')
+                hdrLen = 16
+            elif 0==size:
+                size = end-pos
+            if size<hdrLen:
+                return None
+            if b'moov'==header[4:]:
+                # Descend into moov
+                end = pos+size
+                pos += hdrLen
+            elif b'mvhd'==header[4:]:
+                data = f.read(32)
+                if 1==data[0]:
+                    timescale = int.from_bytes(data[20:24], 'big')
+                    duration = int.from_bytes(data[24:32], 'big')
+                else:
+                    timescale = int.from_bytes(data[12:16], 'big')
+                    duration = int.from_bytes(data[16:20], 'big')
+                return duration/timescale if timescale>0 else None
+            else:
+                pos += size
+    return None
+
+
+def audioRanges(path, f, end):
+    '''
+    Get list of (start, end) byte ranges of the audio in a file, i.e. excluding
+    tags, so that files that only differ in their tags have the same ranges.
+    For MP3s the ID3v2 and ID3v1 tags are skipped, for FLAC the metadata
+    blocks, for m4a only the mdat atom(s) are used, and for Ogg the pages
+    before the first audio page (which hold the comments). Other files are
+    used as-is.
+    '''
+    ext = path.rsplit('.', 1)[1].lower()
+    if 'mp3'==ext:
+        header = f.read(10)
+        start = 10+fromSyncsafe(header[6:10])+(10 if header[5]&0x10 else 0) if 10==len(header) and b'ID3'==header[:3] else 0
+        if end>=start+128:
+            f.seek(end-128)
+            if b'TAG'==f.read(3):
+                end -= 128
+        return [(start, end)]
+    if 'flac'==ext:
+        if b'fLaC'!=f.read(4):
+            return [(0, end)]
+        pos = 4
+        while pos+4<=end:
+            f.seek(pos)
+            header = f.read(4)
+            pos += 4+int.from_bytes(header[1:4], 'big')
+            if header[0]&0x80:
+                return [(pos, end)]
+        return [(0, end)]
+    if 'm4a'==ext:
+        ranges = []
+        pos = 0
+        while pos+8<=end:
+            f.seek(pos)
+            header = f.read(8)
+            size = int.from_bytes(header[:4], 'big')
+            hdrLen = 8
+            if 1==size:
+                size = int.from_bytes(f.read(8), 'big')
+                hdrLen = 16
+            elif 0==size:
+                size = end-pos
+            if size<hdrLen:
+                break
+            if b'mdat'==header[4:]:
+                ranges.append((pos+hdrLen, min(pos+size, end)))
+            pos += size
+        return ranges if len(ranges)>0 else [(0, end)]
+    if 'ogg'==ext:
+        pos = 0
+        while pos+27<=end:
+            f.seek(pos)
+            header = f.read(27)
+            if b'OggS'!=header[:4]:
+                break
+            segments = f.read(header[26])
+            # Header pages have a granule position of 0
+            if 0!=int.from_bytes(header[6:14], 'little'):
+                return [(pos, end)]
+            pos += 27+len(segments)+sum(segments)
+        return [(0, end)]
+    return [(0, end)]
+
+
+def hashTrack(path):
+    '''
+    Hash the audio (ignoring tags) of a file in 'lms'. Returns None if stopped.
+    '''
+    global config
+    digest = hashlib.blake2b(digest_size=16)
+    with open(os.path.join(config['paths']['lms'], path), 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        for start, stop in audioRanges(path, f, end):
+            f.seek(start)
+            while start<stop and not shouldStopNow():
+                data = f.read(min(HASH_CHUNK, stop-start))
+                if not data:
+                    break
+                digest.update(data)
+                start += len(data)
+    return None if shouldStopNow() else digest.hexdigest()
+
+
+def hashTracks(tracks):
+    '''
+    Get hash of each track. Hashes are stored in the index, and are only
+    re-calculated if a file's size or modification time changes.
+    '''
+    global config
+    global index
+    hashes = {}
+    toHash = []
+    for path in tracks:
+        try:
+            st = os.stat(os.path.join(config['paths']['lms'], path))
+        except OSError:
+            continue
+        row = index.execute("select size, mtime, hash from hashes where path=?", (path,)).fetchone()
+        if row is not None and row[0]==st.st_size and row[1]==st.st_mtime_ns:
+            hashes[path] = row[2]
+        else:
+            toHash.append((path, st.st_size, st.st_mtime_ns))
+    if len(toHash)>0:
+        info("Hashing %d file(s)" % len(toHash))
+        with stats.stage('hash'), ThreadPoolExecutor(max_workers=config['threads']) as executor:
+            for (path, size, mtime), future in zip(toHash, [executor.submit(hashTrack, path) for path, size, mtime in toHash]):
+                try:
+                    hash = future.result()
+                except Exception as e:
+                    error("Failed to hash %s - %s" % (path, str(e)), False)
+                    continue
+                if hash is None:
+                    continue
+                hashes[path] = hash
+                index.execute("insert or replace into hashes (path, size, mtime, hash) values (?, ?, ?, ?)", (path, size, mtime, hashes[path]))
+        index.commit()
+    return hashes
+
+
+def findDuplicates(tracks):
+    '''
+    Find tracks with identical audio. With 'duplicates' set to 'link' only the
+    first track of each group is transcoded, the others are then linked to
+    its transcode (see linkDuplicates) - tracks are only grouped if they would
+    be converted the same way, so an MP3 whose tags need fixing is not linked
+    to one that does not. Files that would only be symlinked (ogg, flac, and
+    MP3s that need no fixing) gain nothing from this, so are not hashed. With
+    'skip' the other tracks are not added to MIP at
+    all, and neither are tracks whose audio matches a file that is already in
+    the index (and so has been added to MIP). Returns the list of tracks to
+    transcode. CUE tracks are always transcoded.
+    '''
+    global config
+    global index
+    global duplicates
+    duplicates = {}
+    if 'analyse'==config['duplicates']:
+        return tracks
+    files = [track for track in tracks if not isinstance(track, dict)]
+    actions = {}
+    if 'link'==config['duplicates']:
+        for path in files:
+            if not path.endswith('.ogg') and not path.endswith('.flac'):
+                actions[path] = shouldTranscode(os.path.join(config['paths']['lms'], path))
+        files = [path for path in files if path in actions and LINK!=actions[path]]
+    hashes = hashTracks(files)
+    groups = {}
+    for path in files:
+        if path in hashes:
+            # Only group files of the same type, so that they have the same destination suffix
+            ext = path.rsplit('.', 1)[1].lower()
+            groups.setdefault((hashes[path], ext, actions.get(path)), []).append(path)
+
+    skip = set()
+    for (hash, ext, action), group in groups.items():
+        primary = group[0]
+        if 'skip'==config['duplicates']:
+            # A file already in the index (i.e. not being added now) has been analysed, so always prefer this
+            analysed = [row[0] for row in index.execute("select hashes.path from hashes join files on hashes.path=files.path where hash=?", (hash,))
+                        if not row[0] in hashes and row[0].rsplit('.', 1)[1].lower()==ext]
+            if len(analysed)>0:
+                primary = min(analysed)
+            skip.update([path for path in group if path!=primary])
+        elif len(group)>1:
+            duplicates[primary] = group[1:]
+            skip.update(group[1:])
+        if len(group)>1 or primary!=group[0]:
+            info("Duplicates of %s:" % primary)
+            for path in group:
+                if path!=primary:
+                    info("  %s" % path)
+
+    if len(skip)>0:
+        stats.addDuplicates(len(skip))
+        info("Have %d duplicate file(s), these will %s" % (len(skip), "not be added to MIP" if 'skip'==config['duplicates'] else "use the transcode of the first"))
+    return [track for track in tracks if isinstance(track, dict) or not track in skip]
+
+
+def hasDuplicates(track):
+    return not isinstance(track, dict) and track in duplicates
+
+
+def linkDuplicates(track, dest):
+    '''
+    Create the files in 'mip' for the duplicates of track, by (hard) linking
+    to its transcode. If track was not transcoded (i.e. its file in 'mip' is a
+    symlink to the original) then duplicates are also symlinked to their
+    originals - findDuplicates only groups tracks that would be converted the
+    same way, so these also need no conversion. Returns list of all files
+    created.
+    '''
+    global config
+    dests = destPaths(track)
+    for path, linkDest in zip(duplicates[track], dests[1:]):
+        if os.path.exists(linkDest):
+            continue
+        with dirLock:
+            createDir(os.path.dirname(linkDest))
+            if os.path.islink(dest):
+                os.symlink(os.path.join(config['paths']['lms'], path), linkDest)
+            else:
+                os.link(dest, linkDest)
+    return dests
+
+
+def writeDuplicates(path):
+    '''
+    Write a JSON report of all groups of files in the index with identical
+    audio.
+    '''
+    global index
+    groups = {}
+    for hash, file in index.execute("select hash, path from hashes where hash in (select hash from hashes group by hash having count(*)>1) order by hash, path"):
+        groups.setdefault(hash, []).append(file)
+    with open(path, 'w') as f:
+        json.dump([{'hash':hash, 'files':files} for hash, files in groups.items()], f, indent=1)
+
+
+def estimateSize(track):
+    '''
+    Estimate the number of bytes track (or group of CUE tracks) will use in
+    'mip'. Transcodes are 128kbps MP3 (or 16-bit FLAC), so estimate from
+    duration where this is known - otherwise assume transcode is no larger
+    than the source. Files that are symlinked use no space.
+    '''
+    global config
+    if isinstance(track, dict):
+        return sum([int((float(t['end'])-float(t['start']))*outputBytesPerSec())+FILE_OVERHEAD for t in track['tracks']])
+    ext = track.rsplit('.', 1)[1].lower()
+    if ext in ['ogg', 'flac']:
+        return 0
+    src = os.path.join(config['paths']['lms'], track)
+    try:
+        if 'mp3'==ext and LINK==shouldTranscode(src):
+            return 0 # Symlinked, so uses no space
+        duration = m4aDuration(src) if 'm4a'==ext else None
+        if duration is not None:
+            return int(duration*outputBytesPerSec())+FILE_OVERHEAD
+        return os.path.getsize(src)+FILE_OVERHEAD
+    except Exception:
+        return FILE_OVERHEAD
+
+
+class BatchScheduler:
+    '''
+    Split tracks into batches. If 'batch-size' is configured, each batch is
+    filled (using estimated transcode sizes) up to the smaller of this and
+    the free space in 'mip' (less 'headroom'). Otherwise batches contain
+    'batch' tracks.
+    '''
+    def __init__(self, tracks):
+        self.queue = collections.deque(groupCueTracks(tracks))
+        self.deferred = []
+        self.cleanupPending = threading.Event()
+        self.lock = threading.Lock()
+        self.reserved = 0 # Estimated size of transcodes in progress
+        self.started = 0 # Number of tracks started, for progress
+
+    def hasMore(self):
+        return len(self.queue)>0
+
+    def nextBatch(self, share=1):
+        global config
+        batch = []
+        if config['batch-size'] is None:
+            count = 0
+            while len(self.queue)>0 and count<config['batch']:
+                track = self.queue.popleft()
+                batch.append((track, None))
+                count += trackCount(track)
+            return batch
+
+        budget = min(config['batch-size'], int((freeSpace()-config['headroom'])/share))
+        used = 0
+        while len(self.queue)>0:
+            size = estimateSize(self.queue[0])
+            if len(batch)>0 and used+size>budget:
+                break
+            batch.append((self.queue.popleft(), size))
+            used += size
+        return batch
+
+    def waitForSpace(self, size, mayDefer):
+        '''
+        Wait until there is space in 'mip' for size bytes, allowing for space
+        reserved by transcodes in progress, and reserve this. This will only
+        wait if the previous batch is still to be removed. Returns False if
+        there is (still) insufficient space and the track may be deferred,
+        otherwise space is reserved regardless.
+        '''
+        global config
+        while True:
+            with self.lock:
+                if freeSpace()-config['headroom']-self.reserved >= size or ((not self.cleanupPending.is_set() or shouldStopNow()) and not mayDefer):
+                    self.reserved += size
+                    return True
+            if not self.cleanupPending.is_set() or shouldStopNow():
+                return False
+            time.sleep(1)
+
+    def start(self, count):
+        '''
+        Record that count tracks have been started, returns total started.
+        '''
+        with self.lock:
+            self.started += count
+            return self.started
+
+    def release(self, size):
+        '''
+        Transcode has finished, so its output is now included in freeSpace()
+        '''
+        with self.lock:
+            self.reserved -= size
+
+    def defer(self, tracks):
+        '''
+        Tracks could not be transcoded due to lack of space, so place back at
+        the start of the queue.
+        '''
+        for track in reversed(tracks):
+            self.queue.appendleft(track)
+
+
+def startTrack(track, size, total, scheduler, mayDefer):
+    '''
+    Wait for space for track, and show progress. Returns False if track is to
+    be deferred to next batch.
+    '''
+    path = track['file'] if isinstance(track, dict) else track
+    if size is not None and not scheduler.waitForSpace(size, mayDefer):
+        info("Insufficient space for %s, deferring to next batch" % path)
+        return False
+    count = trackCount(track)
+    if count>1:
+        path = '%s (%d tracks)' % (path, count)
+
+    current = scheduler.start(count)
+    digits=len(str(total))
+    fmt="[{:>%d} {:3}%%] {}" % ((digits*2)+1)
+    info(fmt.format("%d/%d" % (current, total), int(current*100/total), path))
+    return True
+
+
+def completeTrack(track, dest, start):
+    size = 0
+    for file in dest if isinstance(dest, list) else [dest]:
+        stripTags(file)
+        if os.path.exists(file) and not os.path.islink(file):
+            size += os.path.getsize(file)
+    stats.addTrack(track['file'] if isinstance(track, dict) else track, trackCount(track), size, time.monotonic()-start)
+
+
+def processTrack(track, size, total, scheduler, mayDefer):
     if not shouldStop():
-        path = track['file'] if isinstance(track, dict) else track
+        if not startTrack(track, size, total, scheduler, mayDefer):
+            return DEFERRED
+        start = time.monotonic()
+        try:
+            dest = transcode(track)
+        finally:
+            if size is not None:
+                scheduler.release(size)
+        if shouldStopNow():
+            return None # ffmpeg was killed, so output is incomplete
+        completeTrack(track, dest, start)
+        return linkDuplicates(track, dest) if hasDuplicates(track) else dest
+
+
+async def processTrackAsync(track, size, total, scheduler, mayDefer, semaphore):
+    async with semaphore:
+        if not shouldStop():
+            if not await asyncio.to_thread(startTrack, track, size, total, scheduler, mayDefer):
+                return DEFERRED
+            start = time.monotonic()
+            try:
+                dest = await transcodeAsync(track)
+            finally:
+                if size is not None:
+                    scheduler.release(size)
+            if shouldStopNow():
+                return None # ffmpeg was killed, so output is incomplete
+            await asyncio.to_thread(completeTrack, track, dest, start)
+            return await asyncio.to_thread(linkDuplicates, track, dest) if hasDuplicates(track) else dest
+
+
+def runBatchThreads(batch, total, scheduler):
+    futuresList = []
+    results = []
+    with ThreadPoolExecutor(max_workers=config['threads']) as executor:
+        for track, size in batch:
+            futuresList.append(executor.submit(processTrack, track, size, total, scheduler, len(futuresList)>0))
+        for future in futuresList:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    return results
+
+
+async def runBatchAsync(batch, total, scheduler):
+    '''
+    Run a batch using asyncio. ffmpeg processes are started directly from the
+    event loop, with at most 'threads' running at once - other work (tag
+    handling, etc.) is short and so is run in the loop's default executor.
+    '''
+    semaphore = asyncio.Semaphore(config['threads'])
+    tasks = []
+    for track, size in batch:
+        tasks.append(processTrackAsync(track, size, total, scheduler, len(tasks)>0, semaphore))
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def transcodeBatch(batch, total, scheduler):
+    '''
+    Transcode a batch of tracks, returns list of files created in 'mip'. Tracks
+    for which there is insufficient space are passed back to the scheduler.
+    '''
+    tempToRemove = []
+    deferred = []
+    journal.queue([track for track, size in batch])
+    if 'asyncio' == config['engine']:
+        results = asyncio.run(runBatchAsync(batch, total, scheduler))
+    else:
+        results = runBatchThreads(batch, total, scheduler)
+    for (track, size), result in zip(batch, results):
+        if isinstance(result, Exception):
+            path = track['file'] if isinstance(track, dict) else track
+            error("Failed to process %s - %s" % (path, str(result)), False)
+            journal.setState(destPaths(track), JOB_FAILED, str(result))
+        elif DEFERRED == result:
+            deferred.append(track)
+            journal.remove(destPaths(track))
+        elif result is not None:
+            result = result if isinstance(result, list) else [result]
+            tempToRemove += result
+            journal.setState(result, JOB_TRANSCODED)
+    scheduler.defer(deferred)
+    return tempToRemove
+
+
+def processTracksPipelined(scheduler, total, validated):
+    '''
+    Analyse batches whilst transcoding the next. The next batch is only started
+    once MIP has added the current batch, so that MIP never sees partially
+    written files. Files are then removed as soon as validation completes - the
+    next batch may still be being transcoded at this point, but removeTranscode
+    will not remove folders that are in use. Files that MIP has validated are
+    added to validated.
+    '''
+    # Current and next batch will both be in 'mip', so only use half of space for first
+    batch = scheduler.nextBatch(2)
+    tempToRemove = transcodeBatch(batch, total, scheduler)
+    with ThreadPoolExecutor(max_workers=1) as pipe:
+        while True:
+            if shouldStop():
+                return
 
-        digits=len(str(total))
-        fmt="[{:>%d} {:3}%%] {}" % ((digits*2)+1)
-        info(fmt.format("%d/%d" % (current+1, total), int((current+1)*100/total), path))
+            nextBatch = None
+            try:
+                if not addToMip():
+                    return
+                journal.setState(tempToRemove, JOB_ADDED)
+                if scheduler.hasMore() and not shouldStop():
+                    batch = scheduler.nextBatch()
+                    scheduler.cleanupPending.set()
+                    nextBatch = pipe.submit(transcodeBatch, batch, total, scheduler)
+                if not validateInMip():
+                    return
+                journal.setState(tempToRemove, JOB_VALIDATED)
+                validated.update(tempToRemove)
+            except Exception as e:
+                error("MIP is no longer running? %s" % str(e), False)
+                return
 
-        dest = transcode(track)
-        stripTags(dest)
-        return dest
+            for temp in tempToRemove:
+                removeTranscode(temp)
+            journal.remove(tempToRemove)
+            scheduler.cleanupPending.clear()
+            if nextBatch is None:
+                return
+            tempToRemove = nextBatch.result()
 
 
 def processTracks(tracks):
+    '''
+    Transcode tracks, and have MIP analyse them. Returns the set of paths in
+    'mip' that MIP has validated. Files skipped as duplicates (with
+    'duplicates' set to 'skip') are never added to MIP, so their paths are also
+    included.
+    '''
+    validated = set()
     if len(tracks)>config['limit']:
         info("Too many tracks, only processing %d of %d" % (config['limit'], len(tracks)))
         tracks = tracks[:config['limit']]
-    toProcess = len(tracks)
-    total = toProcess
-    processed = 0
-    current = 1
-    while toProcess>0:
+    toProcess = findDuplicates(tracks)
+    if 'skip'==config['duplicates']:
+        kept = set([track for track in toProcess if not isinstance(track, dict)])
+        validated.update([destPaths(track)[0] for track in tracks if not isinstance(track, dict) and not track in kept])
+    tracks = toProcess
+    total = len(tracks)+sum([len(duplicates[track]) for track in tracks if hasDuplicates(track)])
+    scheduler = BatchScheduler(tracks)
+    if scheduler.hasMore() and config['pipeline']:
+        processTracksPipelined(scheduler, total, validated)
+        return validated
+
+    while scheduler.hasMore():
         if shouldStop():
-            return
-        batch = tracks[processed:processed + config['batch']]
-        toProcess -= config['batch']
-        processed += len(batch)
-        futuresList = []
-        tempToRemove = []
-        with ThreadPoolExecutor(max_workers=config['threads']) as executor:
-            for track in batch:
-                futures = {'exe': executor.submit(processTrack, track, current, total), 'track':track}
-                futuresList.append(futures)
-                current+=1
-            for future in futuresList:
-                try:
-                    result = future['exe'].result()
-                    if result is not None:
-                        tempToRemove.append(result)
-                except Exception as e:
-                    path = future['track']['file'] if isinstance(future['track'], dict) else future['track']
-                    error("Failed to process %s - %s" % (path, str(e)))
-                    pass
+            break
+        batch = scheduler.nextBatch()
+        tempToRemove = transcodeBatch(batch, total, scheduler)
         if shouldStop():
-            savePrevious(tempToRemove)
-            return
+            break
 
         if not doAnalysis(tempToRemove):
-            return
+            break
+        validated.update(tempToRemove)
+    return validated
+
+
+def validatedPaths(tracks, validated):
+    '''
+    Get the paths, as used by scanChanged, of the tracks whose files in 'mip'
+    have been validated.
+    '''
+    return [cueTrackPath(track) if isinstance(track, dict) else track for track in tracks if destPaths(track)[0] in validated]
+
+
+class Watcher:
+    '''
+    Watch 'lms', and all folders within, for changes using inotify. Reports the
+    folders (relative to 'lms') that have changed. Raises OSError if inotify is
+    not available, or the watch limit is reached.
+    '''
+    def __init__(self):
+        global config
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        self.addTree('')
+
+    def addDir(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.path.join(config['paths']['lms'], path).encode(), WATCH_MASK)
+        if wd<0:
+            err = ctypes.get_errno()
+            if err in [errno.ENOENT, errno.ENOTDIR]:
+                return # Removed before it could be watched
+            raise OSError(err, 'inotify_add_watch failed for %s : %s' % (path, os.strerror(err)))
+        self.dirs[wd] = path
+
+    def addTree(self, path):
+        self.addDir(path)
+        for dirPath, dirNames, fileNames in os.walk(os.path.join(config['paths']['lms'], path)):
+            for name in dirNames:
+                self.addDir(os.path.relpath(os.path.join(dirPath, name), config['paths']['lms']))
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout seconds for changes. Returns set of changed folders,
+        these will include '' if events were lost.
+        '''
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 64*1024)
+        pos = 0
+        while pos+IN_EVENT.size<=len(data):
+            wd, mask, cookie, length = IN_EVENT.unpack_from(data, pos)
+            name = data[pos+IN_EVENT.size:pos+IN_EVENT.size+length].rstrip(b'\0').decode(errors='surrogateescape')
+            pos += IN_EVENT.size+length
+            if mask & IN_Q_OVERFLOW:
+                changed.add('')
+                continue
+            if not wd in self.dirs:
+                continue
+            path = self.dirs[wd]
+            if mask & IN_IGNORED:
+                del self.dirs[wd]
+                continue
+            if mask & IN_DELETE_SELF:
+                continue # Parent will get IN_DELETE
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.addTree(os.path.join(path, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def scanChanged(changed, known):
+    '''
+    Scan folders that have changed, and return the new or modified files (or
+    CUE tracks) within these. Folders are re-read from disk even if their
+    modification time has not changed, as this is not updated when a file is
+    re-written.
+    '''
+    global config
+    global index
+    global cues
+    if 'lib' in config:
+        # CUE tracks that LMS has found since last read
+        try:
+            cues = readCueTracks(config['lib'])
+        except Exception as e:
+            error("Failed to read CUE tracks from %s : %s" % (config['lib'], str(e)), False)
+
+    dirs = set()
+    for path in changed:
+        while len(path)>0 and not os.path.isdir(os.path.join(config['paths']['lms'], path)):
+            path = os.path.dirname(path)
+        dirs.add(path)
+    # Sub-folders are scanned along with their parent
+    dirs = [d for d in dirs if not any(d!=p and (0==len(p) or d.startswith(p+'/')) for p in dirs)]
+
+    changes = {'new':[], 'changed':[], 'deleted':[]}
+    files = []
+    for path in sorted(dirs):
+        index.execute("update dirs set mtime=-1 where path=?", (path,))
+        files += list(scanDir(path, changes, False))
+    index.commit()
+
+    modified = set(changes['new'] + changes['changed'])
+    tracks = []
+    for file in files:
+        path = cueTrackPath(file) if isinstance(file, dict) else file
+        src = file['file'] if isinstance(file, dict) else file
+        if not path in known or src in modified:
+            tracks.append(file)
+    for path in changes['deleted']:
+        info("%s has been removed, it should be removed from MIP" % path)
+    return tracks
+
+
+def watch(known):
+    '''
+    Wait for files to be added, or changed, in 'lms' and analyse these. Changes
+    are collected until none have been seen for 'watch-debounce' seconds, so
+    that albums being copied are analysed together. inotify is used if
+    available, in addition the whole of 'lms' is re-scanned every
+    'watch-rescan' seconds (e.g. to find changes on network mounts, which
+    inotify does not report).
+    '''
+    global config
+    try:
+        watcher = Watcher()
+        info("Watching %d folder(s) for changes" % len(watcher.dirs))
+    except OSError as e:
+        watcher = None
+        info("inotify is not available (%s), will scan for changes every %ds" % (str(e), config['watch-rescan']))
+
+    changed = set()
+    lastChange = None
+    nextRescan = time.time()+config['watch-rescan']
+    while not shouldStop():
+        if watcher is not None:
+            try:
+                found = watcher.read(1)
+            except OSError as e:
+                info("Failed to watch for changes (%s), will scan for changes every %ds" % (str(e), config['watch-rescan']))
+                watcher.close()
+                watcher = None
+                continue
+            if len(found)>0:
+                changed |= found
+                lastChange = time.time()
+        else:
+            stop_now_event.wait(1)
+        now = time.time()
+        if now>=nextRescan:
+            changed.add('')
+            lastChange = 0
+            nextRescan = now+config['watch-rescan']
+        if len(changed)==0 or now-lastChange<config['watch-debounce']:
+            continue
+
+        with stats.stage('scan'):
+            tracks = scanChanged(changed, known)
+        changed = set()
+        if len(tracks)>0:
+            info("Have %d new or changed file(s) to analyse" % len(tracks))
+            # Tracks that failed are not known, so are retried when next scanned
+            known.update(validatedPaths(tracks, processTracks(tracks)))
+    if watcher is not None:
+        watcher.close()
 
 
 def main():
     global config
-    global db
+    global cues
+    global index
+    global journal
     parser = argparse.ArgumentParser(description='MusicIP File Analyser')
     parser.add_argument('-c', '--config', type=str, help='Config file (default: config.json)', default='config.json')
     parser.add_argument('-d', '--dryrun', action='store_true', default=False, help='Only show changes required')
+    parser.add_argument('-f', '--full-rescan', action='store_true', default=False, help='Ignore scan index, and read all folders')
+    parser.add_argument('-i', '--reanalyse-inactive', action='store_true', default=False, help='Re-analyse songs MIP reports as inactive')
+    parser.add_argument('-r', '--report', type=str, help='Write JSON report of stage timings, etc, to this file', default=None)
+    parser.add_argument('-p', '--prometheus', type=str, help='Write stage timings, etc, to this file in Prometheus text format', default=None)
+    parser.add_argument('-D', '--duplicates', type=str, help='Write groups of files with identical audio to this JSON file', default=None)
+    parser.add_argument('-w', '--watch', action='store_true', default=False, help='After analysing, keep running and analyse new files as they are added')
 
     args = parser.parse_args()
 
@@ -428,9 +1832,63 @@ def main():
     if not 'limit' in config:
         config['limit']=1000000
 
+    if not 'pipeline' in config:
+        config['pipeline']=False
+
+    if not 'mip' in config:
+        config['mip']={}
+    config['mip']['host']=config['mip']['host'] if 'host' in config['mip'] else 'localhost'
+    config['mip']['port']=int(config['mip']['port']) if 'port' in config['mip'] else 10002
+
+    if not 'poll' in config:
+        config['poll']=5
+
+    if not 'engine' in config:
+        config['engine']='threads'
+    elif not config['engine'] in ['threads', 'asyncio']:
+        error("Unknown engine '%s'" % config['engine'])
+
+    if not 'output-format' in config:
+        config['output-format']='mp3'
+    elif not config['output-format'] in OUTPUT_FORMATS:
+        error("Unknown output-format '%s'" % config['output-format'])
+    config['output-channels']=int(config['output-channels']) if 'output-channels' in config else None
+    config['output-rate']=int(config['output-rate']) if 'output-rate' in config else None
+
+    if not 'duplicates' in config:
+        config['duplicates']='analyse'
+    elif not config['duplicates'] in DUPLICATE_MODES:
+        error("Unknown duplicates '%s'" % config['duplicates'])
+
+    if not 'reanalyse-attempts' in config:
+        config['reanalyse-attempts']=3
+
+    if not 'reanalyse-limit' in config:
+        config['reanalyse-limit']=100
+
+    if not 'watch-debounce' in config:
+        config['watch-debounce']=30
+
+    if not 'watch-rescan' in config:
+        config['watch-rescan']=3600
+
+    config['batch-size'] = parseSize(config['batch-size']) if 'batch-size' in config else None
+    config['headroom'] = parseSize(config['headroom'] if 'headroom' in config else '32M')
+
+    if not 'index' in config:
+        config['index']=os.path.join(os.path.dirname(os.path.abspath(args.config)), 'mip-analyser.db')
+    index = openIndex(config['index'])
+
+    if not 'journal' in config:
+        config['journal']=os.path.join(os.path.dirname(os.path.abspath(args.config)), 'mip-analyser-journal.db')
+    journal = Journal(config['journal'])
+
     # 'lib' should be LMS's library.db file - need to get details of CUE tracks
     if 'lib' in config:
-        db = sqlite3.connect(config['lib'])
+        try:
+            cues = readCueTracks(config['lib'])
+        except Exception as e:
+            error("Failed to read CUE tracks from %s : %s" % (config['lib'], str(e)))
 
     signal.signal(signal.SIGINT, sigHandler)
 
@@ -440,26 +1898,54 @@ def main():
     except Exception as e:
         error("MIP is not running : %s" % str(e))
 
+    try:
+        known = analyse(args)
+        if args.watch and not args.dryrun and known is not None and not shouldStop():
+            watch(known)
+    finally:
+        if args.report is not None:
+            stats.writeReport(args.report)
+        if args.prometheus is not None:
+            stats.writePrometheus(args.prometheus)
+        if args.duplicates is not None:
+            writeDuplicates(args.duplicates)
+        report = stats.report()
+        info("Processed %d track(s) in %.1fs (%.1f tracks/min)" % (report['tracks'], report['duration'], report['tracks_per_min']))
+
+
+def analyse(args):
     info("Query MIP for its known songs")
-    mipSongs, inactiveSongs = getMipSongs()
-    files = []
+    with stats.stage('mip-songs'):
+        mipSongs, inactiveSongs = getMipSongs()
     info("Query filesystem/LMS for songs")
-    getFiles(config['paths']['lms'], files)
-    toAdd, toRemove = check(mipSongs, files)
+    changes = {'new':[], 'changed':[], 'deleted':[]}
+    known = set(mipSongs) if args.watch else None
+    with stats.stage('scan'):
+        toAdd, toRemove = check(mipSongs, getFiles(changes, args.full_rescan))
+    info("Have %d new, %d changed, and %d deleted file(s) since last scan" % (len(changes['new']), len(changes['changed']), len(changes['deleted'])))
     info("Have %d file(s) to add" % len(toAdd))
     info("Have %d file(s) to remove" % len(toRemove))
     info("Have %d files(s) that are inactive" % len(inactiveSongs))
 
+    validated = set()
     if not args.dryrun:
         # Check if we have any files left over from a previous run, and if so anayse now
-        previous = readPrevious()
+        previous = journal.resume()
         if len(previous)>0:
             info("Have %d file(s) to analyse from previous run" % len(previous))
             if not doAnalysis(previous):
-                return
+                return None
+            validated.update(previous)
+
+        tracks = [track for track in toAdd if not all([dest in validated for dest in destPaths(track)])]
+        if len(tracks)>0:
+            validated.update(processTracks(tracks))
 
-        if len(toAdd)>0:
-            processTracks(toAdd)
+        if args.reanalyse_inactive and len(inactiveSongs)>0 and not shouldStop():
+            tracks, inactiveSongs = selectInactive(inactiveSongs)
+            if len(tracks)>0:
+                info("Re-analysing %d inactive file(s)" % len(tracks))
+                processTracks(tracks)
 
     if len(toRemove)>0:
         info(" ")
@@ -474,6 +1960,10 @@ def main():
             info("  %s" % path)
         info(" ")
 
+    if known is not None:
+        known.update(validatedPaths(toAdd, validated))
+    return known
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+#
+# Load test mip-proxy.py against a fake MusicIP server
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse, datetime, json, os, random, socket, subprocess, sys, threading, time
+import urllib.error, urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FNULL = open(os.devnull, 'w')
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mip-proxy.py')
+LMS_ROOT = '/bench/Music/'
+MIP_ROOT = '/bench/MusicIP/'
+MOODS = b'Aggressive\nAmbient\nDance\nHappy\nMellow\nUpbeat\n'
+
+
+def info(s):
+    print("[%s] %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), s))
+
+
+def error(s):
+    print("[%s] ERROR: %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), s))
+    exit(-1)
+
+
+def songPath(index, cue):
+    '''
+    Path of a song as MusicIP would know it. Every 3rd song is an m4a (and so
+    has been transcoded to mp3), and if cue is set every 5th is a CUE track.
+    '''
+    folder = '%sArtist %d/Album %d/' % (MIP_ROOT, index%97, index//10)
+    if cue and 0 == index%5:
+        return '%salbum.flac.CUE_TRACK.%d-%d.mp3' % (folder, (index%10)*180, (index%10+1)*180)
+    if 0 == index%3:
+        return '%s%02d Track.m4a.mp3' % (folder, index%10+1)
+    return '%s%02d Track.mp3' % (folder, index%10+1)
+
+
+class FakeMip:
+    '''
+    Canned replies of a fake MusicIP server. api/mix returns 'size' (or
+    mixSize) songs,
+    api/songs returns the whole library of 'songs' songs. Each reply is
+    delayed by its endpoint's latency.
+    '''
+    def __init__(self, songs, mixSize, cue, mixLatency, songsLatency, latency):
+        self.songs = songs
+        self.mixSize = mixSize
+        self.cue = cue
+        self.latency = {'/api/mix':mixLatency, '/api/songs':songsLatency}
+        self.defaultLatency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.listing = b''.join(('file %s\nactive yes\n' % songPath(i, cue)).encode() for i in range(songs))
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def mix(self, seed, size):
+        rand = random.Random(seed)
+        return ''.join('%s\n' % songPath(rand.randrange(self.songs), self.cue) for i in range(size)).encode()
+
+
+class FakeMipHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, code=200):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mip = self.server.mip
+        url = urllib.parse.urlparse(self.path)
+        mip.count(url.path)
+        time.sleep(mip.latency.get(url.path, mip.defaultLatency))
+        if '/api/mix' == url.path:
+            params = urllib.parse.parse_qs(url.query)
+            self.send(mip.mix(url.query, int(params['size'][0]) if 'size' in params else mip.mixSize))
+        elif '/api/songs' == url.path:
+            self.send(mip.listing)
+        elif '/api/moods' == url.path:
+            self.send(MOODS)
+        elif '/api/getStatus' == url.path:
+            self.send(b'idle')
+        elif '/api/version' == url.path:
+            self.send(b'MusicMagic Mixer API version 1.9\n')
+        elif '/api/cacheid' == url.path:
+            self.send(b'1\n')
+        else:
+            self.send(b'Not found', 404)
+
+
+def startServer(args):
+    srv = ThreadingHTTPServer(('localhost', args.port), FakeMipHandler)
+    srv.daemon_threads = True
+    srv.mip = FakeMip(args.songs, args.mix_size, args.cue, args.mix_latency, args.songs_latency, args.latency)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+class RecordHandler(BaseHTTPRequestHandler):
+    '''
+    Pass requests from LMS on to the proxy, and log the time and URI of each.
+    '''
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        rec = self.server
+        with rec.lock:
+            rec.log.write(json.dumps({'time':time.time()-rec.start, 'uri':self.path}) + '\n')
+            rec.log.flush()
+        try:
+            resp = urllib.request.urlopen('http://%s%s' % (rec.target, self.path))
+            code, body = resp.getcode(), resp.read()
+        except urllib.error.HTTPError as e:
+            code, body = e.code, e.read()
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def record(args):
+    '''
+    Listen for LMS requests, forward these to the proxy, and write each
+    request to a log that 'run' can replay.
+    '''
+    srv = ThreadingHTTPServer(('', args.listen), RecordHandler)
+    srv.target = args.target
+    srv.lock = threading.Lock()
+    srv.log = open(args.output, 'a')
+    srv.start = time.time()
+    info("Recording requests on %d to %s, forwarding to %s" % (args.listen, args.output, args.target))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    srv.log.close()
+
+
+def readRecording(path):
+    '''
+    Read URIs from a recording. Paths recorded from a real LMS will not be in
+    the fake library, so song paths are replaced with ones that are.
+    '''
+    uris = []
+    with open(path, 'r') as f:
+        for line in f:
+            uri = json.loads(line)['uri']
+            url = urllib.parse.urlparse(uri)
+            params = urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+            if any('song'==k for k, v in params):
+                song = LMS_ROOT + songPath(len(uris), False)[len(MIP_ROOT):].replace('.m4a.mp3', '.m4a')
+                params = [(k, song if 'song'==k else v) for k, v in params]
+                uri = '%s?%s' % (url.path, urllib.parse.urlencode(params, quote_via=urllib.parse.quote))
+            uris.append(uri)
+    return uris
+
+
+def syntheticRequests(args):
+    '''
+    Mostly mixes (as DSTM would request), with some status checks, and
+    occasionally the full song listing.
+    '''
+    rand = random.Random(args.seed)
+    uris = []
+    for i in range(args.requests):
+        r = rand.random()
+        if r < args.songs_fraction:
+            uris.append('/api/songs')
+        elif r < 0.8:
+            song = LMS_ROOT + songPath(rand.randrange(args.songs), False)[len(MIP_ROOT):].replace('.m4a.mp3', '.m4a')
+            uris.append('/api/mix?song=%s&size=%d' % (urllib.parse.quote(song, safe=''), args.mix_size))
+        elif r < 0.9:
+            uris.append('/api/getStatus')
+        elif r < 0.95:
+            uris.append('/api/moods')
+        else:
+            uris.append('/api/version')
+    return uris
+
+
+def peakRss(pid):
+    '''
+    Read peak RSS (in KB) of process.
+    '''
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+def waitForPort(port, proc):
+    for i in range(100):
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('localhost', port), 0.1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def fetch(port, uri):
+    start = time.monotonic()
+    try:
+        resp = urllib.request.urlopen('http://localhost:%d%s' % (port, uri), timeout=60)
+        code, size = resp.getcode(), len(resp.read())
+    except urllib.error.HTTPError as e:
+        code, size = e.code, 0
+    except Exception:
+        code, size = 0, 0
+    return (uri.split('?')[0], code, size, time.monotonic()-start)
+
+
+def percentile(values, pc):
+    return values[min(len(values)-1, int(len(values)*pc/100))] if len(values)>0 else 0
+
+
+def summarise(name, times):
+    times = sorted(times)
+    return "%-16s %6d  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms" % (name, len(times), percentile(times, 50)*1000,
+                                                                 percentile(times, 95)*1000, percentile(times, 99)*1000)
+
+
+def run(args):
+    '''
+    Start the fake MusicIP server and the proxy, replay requests against the
+    proxy at the given concurrency, and report latency, throughput, and the
+    proxy's peak memory.
+    '''
+    os.makedirs(args.dir, exist_ok=True)
+    srv = startServer(args)
+    config = {'port':args.proxy_port,
+              'mip':{'host':'localhost', 'port':args.port, 'timeout':60},
+              'paths':{'lms':LMS_ROOT, 'mip':MIP_ROOT},
+              'transcode':['m4a'],
+              'debug':False,
+              'cue':args.cue,
+              'cache':{'size':args.cache_size},
+              'exists':{'sample':0}}
+    configPath = os.path.join(args.dir, 'proxy-config.json')
+    with open(configPath, 'w') as f:
+        json.dump(config, f)
+
+    uris = readRecording(args.replay) if args.replay is not None else syntheticRequests(args)
+    if len(uris) == 0:
+        error("No requests to send")
+    proc = subprocess.Popen([sys.executable, PROXY, '-c', configPath], stdout=FNULL if not args.verbose else None, stderr=subprocess.STDOUT)
+    try:
+        if not waitForPort(args.proxy_port, proc):
+            error("Proxy failed to start, re-run with --verbose for details")
+        info("Sending %d request(s) to proxy, %d at a time (%s paths)" % (len(uris), args.concurrency, 'CUE' if args.cue else 'non-CUE'))
+        peak = [0]
+        done = threading.Event()
+
+        def monitor():
+            while not done.is_set():
+                peak[0] = max(peak[0], peakRss(proc.pid))
+                done.wait(0.1)
+
+        threading.Thread(target=monitor, daemon=True).start()
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda uri: fetch(args.proxy_port, uri), uris))
+        duration = time.monotonic()-start
+        done.set()
+        peak[0] = max(peak[0], peakRss(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait()
+        srv.shutdown()
+
+    errors = [r for r in results if 200 != r[1]]
+    endpoints = {}
+    for r in results:
+        endpoints.setdefault(r[0], []).append(r[3])
+    info("%d request(s) in %.2fs, %.1f requests/s, %d error(s), %.1fMB received, proxy peak RSS %dKB" %
+         (len(results), duration, len(results)/duration, len(errors), sum(r[2] for r in results)/(1024*1024), peak[0]))
+    info("    %s" % summarise('all', [r[3] for r in results]))
+    for name in sorted(endpoints):
+        info("    %s" % summarise(name, endpoints[name]))
+    info("    MusicIP received %d request(s)" % sum(srv.mip.requests.values()))
+    if args.output is not None:
+        res = {'requests':len(results), 'duration':duration, 'requests_per_sec':len(results)/duration, 'errors':len(errors),
+               'peak_rss_kb':peak[0], 'cue':args.cue, 'concurrency':args.concurrency, 'endpoints':{}}
+        for name, times in list(endpoints.items()) + [('all', [r[3] for r in results])]:
+            times = sorted(times)
+            res['endpoints'][name] = {'count':len(times), 'p50':percentile(times, 50), 'p95':percentile(times, 95), 'p99':percentile(times, 99)}
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MusicIP Proxy Benchmark')
+    sub = parser.add_subparsers(dest='cmd')
+    srv = sub.add_parser('serve', help='Only run fake MusicIP server')
+    run_ = sub.add_parser('run', help='Send requests to proxy, using fake MusicIP server')
+    for p in [srv, run_]:
+        p.add_argument('-p', '--port', type=int, default=10012, help='Fake MusicIP port (default: 10012)')
+        p.add_argument('--songs', type=int, default=10000, help='Number of songs in library (default: 10000)')
+        p.add_argument('--mix-size', type=int, default=50, help='Songs per mix (default: 50)')
+        p.add_argument('--cue', action='store_true', default=False, help='Include CUE tracks, and enable proxy CUE support')
+        p.add_argument('--mix-latency', type=float, default=0.2, help='Seconds MusicIP takes to create a mix (default: 0.2)')
+        p.add_argument('--songs-latency', type=float, default=1.0, help='Seconds MusicIP takes to list songs (default: 1.0)')
+        p.add_argument('--latency', type=float, default=0.01, help='Seconds MusicIP takes for other requests (default: 0.01)')
+    run_.add_argument('-d', '--dir', type=str, default='/tmp/mip-proxy-bench', help='Folder for proxy config (default: /tmp/mip-proxy-bench)')
+    run_.add_argument('--proxy-port', type=int, default=10013, help='Port to run proxy on (default: 10013)')
+    run_.add_argument('-n', '--requests', type=int, default=500, help='Number of synthetic requests (default: 500)')
+    run_.add_argument('-c', '--concurrency', type=int, default=4, help='Requests to send at a time, e.g. number of players (default: 4)')
+    run_.add_argument('--songs-fraction', type=float, default=0.002, help='Fraction of requests that list all songs (default: 0.002)')
+    run_.add_argument('--cache-size', type=int, default=0, help='Proxy cache size in MB (default: 0, disabled)')
+    run_.add_argument('-r', '--replay', type=str, default=None, help='Replay requests from a recording, instead of synthetic requests')
+    run_.add_argument('-s', '--seed', type=int, default=1, help='Random seed (default: 1)')
+    run_.add_argument('-o', '--output', type=str, default=None, help='Write results to JSON file')
+    run_.add_argument('-v', '--verbose', action='store_true', default=False, help='Show proxy output')
+    rec = sub.add_parser('record', help='Record LMS requests, whilst passing them on to the proxy')
+    rec.add_argument('-l', '--listen', type=int, default=10004, help='Port to listen on, configure LMS to use this (default: 10004)')
+    rec.add_argument('-t', '--target', type=str, default='localhost:10003', help='Proxy host:port (default: localhost:10003)')
+    rec.add_argument('-o', '--output', type=str, default='requests.log', help='File to append requests to (default: requests.log)')
+    args = parser.parse_args()
+
+    if 'run'==args.cmd:
+        run(args)
+    elif 'record'==args.cmd:
+        record(args)
+    elif 'serve'==args.cmd:
+        startServer(args)
+        info("Fake MusicIP listening on: %d" % args.port)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
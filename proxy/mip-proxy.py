@@ -10,15 +10,34 @@
 import argparse
 import json
 import os
+import random
+import re
 import sys
-from urllib.parse import quote
-import urllib.request
+import time
+from collections import OrderedDict
+from urllib.parse import quote, quote_from_bytes, unquote_to_bytes
 
 from twisted.web import server, resource
-from twisted.internet import reactor
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone, readBody
+from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.http_headers import Headers
+from twisted.internet import defer, protocol, reactor, task, threads
+from twisted.python.failure import Failure
 
 
 config={}
+agent=None
+cache=None
+translators={}
+existence=None
+precompute=None
+CUE_TRACK=b'.CUE_TRACK.'
+OUTPUT_FORMATS=['mp3', 'flac']
+METRICS_PATH=b'/proxy/metrics'
+CACHEID_URI=b'/api/cacheid?contents'
+DEFAULT_CACHE_TTL={'api/version':3600, 'api/moods':3600, 'api/filters':3600, 'api/genres':600, 'api/artists':600,
+                   'api/albums':600, 'api/playlists':600, 'api/mix':300}
 
 def debug(s):
     global config
@@ -35,6 +54,91 @@ def error(s):
     exit(-1)
 
 
+class PathTranslator:
+    """ Path/extension rewrites for one direction, built once from config. Rules are applied with bytes.replace over the
+        whole buffer, which is much quicker than calling a regex replacement function per match. In cue mode only
+        lines containing .CUE_TRACK. are handled one at a time. """
+    def __init__(self, rules, std=None):
+        self.rules=[r for r in rules if r[0]!=r[1]]
+        self.std=std if std is not None and std[0]!=std[1] else None
+        # Replacing across a whole buffer is only the same as replacing line by line if no rule contains a newline
+        self.perLine=any(b'\n' in r[0]+r[1] for r in self.rules+([self.std] if self.std else []))
+
+    def translate(self, data):
+        for r in self.rules:
+            data=data.replace(r[0], r[1])
+        return data
+
+    def translateCue(self, data):
+        """ std path is replaced in every line, rules only in lines that are not cue tracks. Returns the translated data
+            and the set of line numbers which were cue tracks """
+        cueLines=set()
+        if self.perLine:
+            resp=[]
+            for line in data.split(b'\n'):
+                if self.std:
+                    line=line.replace(self.std[0], self.std[1])
+                if CUE_TRACK in line:
+                    cueLines.add(len(resp))
+                    line=cueLine(line)
+                else:
+                    line=self.translate(line)
+                resp.append(line)
+            return b'\n'.join(resp), cueLines
+
+        if self.std:
+            data=data.replace(self.std[0], self.std[1])
+        if not CUE_TRACK in data:
+            return self.translate(data), cueLines
+        parts=[]
+        line=0
+        start=0
+        pos=data.find(CUE_TRACK)
+        while pos>=0:
+            lineStart=data.rfind(b'\n', 0, pos)+1
+            lineEnd=data.find(b'\n', pos)
+            if lineEnd<0:
+                lineEnd=len(data)
+            line+=data.count(b'\n', start, lineStart)
+            cueLines.add(line)
+            parts.append(self.translate(data[start:lineStart]))
+            parts.append(cueLine(data[lineStart:lineEnd]))
+            start=lineEnd
+            pos=data.find(CUE_TRACK, lineEnd)
+        parts.append(self.translate(data[start:]))
+        return b''.join(parts), cueLines
+
+
+def createTranslators():
+    global config, translators
+    paths=config['paths']
+    for frm, to in [('mip', 'lms'), ('lms', 'mip')]:
+        # Songs transcoded to any format are converted to LMS paths, but LMS paths are only converted to 'output-format'
+        rules=[(t[frm], t[to]) for t in config['types'] if frm=='mip' or t['format']==config['output-format']]
+        rules.append((paths['std'][frm], paths['std'][to]))
+        rules.append((paths['enc'][frm], paths['enc'][to]))
+        translators[frm]=PathTranslator(rules)
+    # Cue mode MIP responses: std path is replaced in every line, types only in non-cue lines
+    translators['cue']=PathTranslator([(t['mip'], t['lms']) for t in config['types']], (paths['std']['mip'], paths['std']['lms']))
+
+
+def cueLine(line):
+    # /path/file.m4a.CUE_TRACK.start-stop.mp3 (or .flac) -> /path/file.m4a#start-stop
+    addprefix = False
+    if line.startswith(b'file '):
+        line=line[5:].replace(CUE_TRACK, b'#')
+        addprefix = True
+    else:
+        line=line.replace(CUE_TRACK, b'#')
+    parts=line.split(b'#')
+    for fmt in OUTPUT_FORMATS:
+        parts[1]=parts[1].replace(b'.'+fmt.encode(), b'')
+    line=b'file://'+str.encode(quote(parts[0]))+b'#'+parts[1]
+    if addprefix:
+        line=b'file '+line
+    return line
+
+
 def fixPaths(data, frm, to):
     if data:
         global config
@@ -46,70 +150,644 @@ def fixPaths(data, frm, to):
         # Cue file hack support?
         if 'cue' in config and config['cue']:
             if frm=='mip':
-                resp=[]
-                for line in data.split(b'\n'):
-                    orig=line.decode("utf-8")
-                    line=line.replace(config['paths']['std'][frm], config['paths']['std'][to])
-                    # /path/file.m4a.CUE_TRACK.start-stop.mp3 -> /path/file.m4a#start-stop
-                    if b'.CUE_TRACK.' in line:
-                        addprefix = False
-                        if line.startswith(b'file '):
-                            line=line[5:].replace(b'.CUE_TRACK.', b'#').replace(b'.mp3', b'')
-                            addprefix = True
-                        else:
-                            line=line.replace(b'.CUE_TRACK.', b'#').replace(b'.mp3', b'')
-                        parts=line.split(b'#')
-                        line=b'file://'+str.encode(quote(parts[0]))+b'#'+parts[1]
-                        if addprefix:
-                            line=b'file '+line
-                    else:
-                        for t in config['types']:
-                            line=line.replace(t[frm], t[to])
-                        dest=line.decode("utf-8")
-                        if len(dest)>3 and not os.path.exists(dest):
-                            warning("%s does not exist. MIP:%s" % (dest, orig))
-                    resp.append(line)
-                data=b'\n'.join(resp)
+                orig=data
+                data, cueLines=translators['cue'].translateCue(data)
+                if existence is not None:
+                    existence.sample(orig, data, cueLines)
             else:
                 data=data.replace(config['paths']['enc'][frm], config['paths']['enc'][to])
                 pos=data.find(b'%23')
                 if pos>0:
                     # Replace file:///path/file.m4a#from-to&param with /path/file.m4a.CUE_TRACK.from-to.mp3&param
+                    suffix=b'.'+config['output-format'].encode()
                     amp=data.find(b'&', pos)
                     if amp>0:
-                        data=data[:pos]+b'.CUE_TRACK.'+data[pos+3:amp]+b'.mp3'+data[amp:]
+                        data=data[:pos]+CUE_TRACK+data[pos+3:amp]+suffix+data[amp:]
                     else:
-                        data=data[:pos]+b'.CUE_TRACK.'+data[pos+3:]+b'.mp3'
+                        data=data[:pos]+CUE_TRACK+data[pos+3:]+suffix
                     data=data.replace(b'file%3A%2F%2F', b'')
                 else:
                     for t in config['types']:
-                        data=data.replace(t[frm], t[to])
+                        if t['format']==config['output-format']:
+                            data=data.replace(t[frm], t[to])
                 data=data.replace(b'%2520', b'%20')
         else:
-            for t in config['types']:
-                data=data.replace(t[frm], t[to])
-            data=data.replace(config['paths']['std'][frm], config['paths']['std'][to])
-            data=data.replace(config['paths']['enc'][frm], config['paths']['enc'][to])
+            data=translators[frm].translate(data)
         if showDebug:
             debug("TO:%s" % data.decode("utf-8"))
     return data
 
 
+class Histogram:
+    """ Prometheus style histogram, per endpoint """
+    def __init__(self, name, help, buckets):
+        self.name=name
+        self.help=help
+        self.buckets=buckets
+        self.values={}
+
+    def observe(self, endpoint, value):
+        if not endpoint in self.values:
+            self.values[endpoint]={'buckets':[0]*len(self.buckets), 'count':0, 'sum':0}
+        entry=self.values[endpoint]
+        for i in range(len(self.buckets)):
+            if value<=self.buckets[i]:
+                entry['buckets'][i]+=1
+        entry['count']+=1
+        entry['sum']+=value
+
+    def lines(self):
+        lines=['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for endpoint, entry in sorted(self.values.items()):
+            for bucket, count in zip(self.buckets, entry['buckets']):
+                lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (self.name, endpoint, bucket, count))
+            lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (self.name, endpoint, entry['count']))
+            lines.append('%s_sum{endpoint="%s"} %f' % (self.name, endpoint, entry['sum']))
+            lines.append('%s_count{endpoint="%s"} %d' % (self.name, endpoint, entry['count']))
+        return lines
+
+
+class Metrics:
+    """ Request counts, timings, and sizes - served in Prometheus text format from /proxy/metrics """
+    LATENCY_BUCKETS=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    SIZE_BUCKETS=[256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+    def __init__(self):
+        self.requests={}
+        self.upstreamErrors={}
+        self.inFlight=0
+        self.backends=[]
+        self.cacheHits=0
+        self.cacheMisses=0
+        self.missingPaths=0
+        self.precomputed=0
+        self.precomputeHits=0
+        self.latency=Histogram('mip_proxy_request_seconds', 'Time taken to reply to LMS', Metrics.LATENCY_BUCKETS)
+        self.upstream=Histogram('mip_proxy_upstream_seconds', 'Time taken for MusicIP to reply', Metrics.LATENCY_BUCKETS)
+        self.translate=Histogram('mip_proxy_translate_seconds', 'Time taken to translate paths in MusicIP replies', Metrics.LATENCY_BUCKETS)
+        self.size=Histogram('mip_proxy_response_bytes', 'Size of replies sent to LMS', Metrics.SIZE_BUCKETS)
+
+    def endpoint(self, uri):
+        """ Label for a request, limited to MusicIP's endpoint names so that the number of series is bounded """
+        path=uri.split(b'?')[0].strip(b'/').decode("utf-8", "replace")
+        return path if re.fullmatch('(api|server)/[A-Za-z]+', path) else 'other'
+
+    def requestDone(self, endpoint, code, duration, size):
+        key=(endpoint, code)
+        self.requests[key]=self.requests.get(key, 0)+1
+        self.latency.observe(endpoint, duration)
+        self.size.observe(endpoint, size)
+
+    def upstreamError(self, code):
+        self.upstreamErrors[code]=self.upstreamErrors.get(code, 0)+1
+
+    def render(self):
+        lines=['# HELP mip_proxy_requests_total Requests from LMS', '# TYPE mip_proxy_requests_total counter']
+        for (endpoint, code), count in sorted(self.requests.items()):
+            lines.append('mip_proxy_requests_total{endpoint="%s",code="%d"} %d' % (endpoint, code, count))
+        lines+=['# HELP mip_proxy_upstream_errors_total Failed requests to MusicIP', '# TYPE mip_proxy_upstream_errors_total counter']
+        for code, count in sorted(self.upstreamErrors.items()):
+            lines.append('mip_proxy_upstream_errors_total{code="%s"} %d' % (code, count))
+        lines+=['# TYPE mip_proxy_in_flight gauge', 'mip_proxy_in_flight %d' % self.inFlight]
+        lines+=['# TYPE mip_proxy_upstream_in_flight gauge', 'mip_proxy_upstream_in_flight %d' % sum(b.outstanding for b in self.backends)]
+        lines.append('# TYPE mip_proxy_backend_outstanding gauge')
+        for backend in self.backends:
+            lines.append('mip_proxy_backend_outstanding{backend="%s"} %d' % (backend.name, backend.outstanding))
+        lines.append('# TYPE mip_proxy_backend_healthy gauge')
+        for backend in self.backends:
+            lines.append('mip_proxy_backend_healthy{backend="%s"} %d' % (backend.name, 1 if backend.healthy else 0))
+        lines+=['# TYPE mip_proxy_cache_hits_total counter', 'mip_proxy_cache_hits_total %d' % self.cacheHits]
+        lines+=['# TYPE mip_proxy_cache_misses_total counter', 'mip_proxy_cache_misses_total %d' % self.cacheMisses]
+        lines+=['# TYPE mip_proxy_missing_paths_total counter', 'mip_proxy_missing_paths_total %d' % self.missingPaths]
+        lines+=['# TYPE mip_proxy_precomputed_mixes_total counter', 'mip_proxy_precomputed_mixes_total %d' % self.precomputed]
+        lines+=['# TYPE mip_proxy_precompute_hits_total counter', 'mip_proxy_precompute_hits_total %d' % self.precomputeHits]
+        for histogram in [self.latency, self.upstream, self.translate, self.size]:
+            lines+=histogram.lines()
+        return ('\n'.join(lines)+'\n').encode('utf-8')
+
+
+metrics=Metrics()
+
+
+def requestKey(uri):
+    """ Key for caching, and coalescing, requests. Parameter names and values are decoded, sorted, and then
+        re-encoded, so that the same request is found however it was encoded - but an encoded '&' or '=' within
+        a value is kept distinct from a separator. """
+    if not b'?' in uri:
+        return uri
+    path, query = uri.split(b'?', 1)
+    params=sorted(tuple(unquote_to_bytes(part) for part in param.split(b'=', 1)) for param in query.split(b'&'))
+    return path+b'?'+b'&'.join(b'='.join(quote_from_bytes(part, safe='').encode() for part in param) for param in params)
+
+
+def translateResponse(data, endpoint):
+    start=time.monotonic()
+    data=fixPaths(data, 'mip', 'lms')
+    metrics.translate.observe(endpoint, time.monotonic()-start)
+    return data
+
+
+class ExistenceChecker:
+    """ Checks that a sample of the paths sent to LMS exist. Checks are run in a thread, results are cached, and
+        missing files are reported periodically rather than per response. """
+    def __init__(self, percent, ttl, size):
+        self.percent=percent
+        self.ttl=ttl
+        self.size=size
+        self.known=OrderedDict()
+        self.queue=OrderedDict()
+        self.missing=OrderedDict()
+        self.checking=False
+
+    def sample(self, orig, data, cueLines):
+        lines=data.split(b'\n')
+        indexes=range(len(lines))
+        if self.percent<100:
+            indexes=random.sample(indexes, (len(lines)*self.percent+99)//100)
+        origLines=None
+        now=time.monotonic()
+        for i in indexes:
+            dest=lines[i]
+            if dest.startswith(b'file '):
+                dest=dest[5:]
+            # Only check lines that are paths, e.g. not 'active yes' from song listings
+            if i in cueLines or len(dest)<=3 or not dest.startswith(b'/') or dest in self.queue:
+                continue
+            if dest in self.known and self.known[dest]>now:
+                continue
+            if len(self.queue)>=self.size:
+                break
+            if origLines is None:
+                origLines=orig.split(b'\n')
+            self.queue[dest]=origLines[i]
+        self.checkNext()
+
+    def checkNext(self):
+        if self.checking or len(self.queue)==0:
+            return
+        self.checking=True
+        paths=self.queue
+        self.queue=OrderedDict()
+        d=threads.deferToThread(lambda: [p for p in paths if not os.path.exists(p)])
+        d.addCallback(self.checked, paths)
+        d.addErrback(lambda f: warning("Failed to check paths - %s" % f.getErrorMessage()))
+        d.addBoth(self.finished)
+
+    def checked(self, notFound, paths):
+        expiry=time.monotonic()+self.ttl
+        for path in paths:
+            self.known.pop(path, None)
+            self.known[path]=expiry
+        while len(self.known)>self.size:
+            self.known.popitem(last=False)
+        metrics.missingPaths+=len(notFound)
+        for path in notFound:
+            if len(self.missing)<self.size:
+                self.missing[path]=paths[path]
+
+    def finished(self, _):
+        self.checking=False
+        self.checkNext()
+
+    def report(self):
+        if len(self.missing)==0:
+            return
+        warning("%d file(s) sent to LMS do not exist, e.g.:\n%s" % (len(self.missing), "\n".join(
+                "  %s (MIP:%s)" % (dest.decode("utf-8", "replace"), src.decode("utf-8", "replace"))
+                for dest, src in list(self.missing.items())[:10])))
+        self.missing.clear()
+
+
+class ResponseCache:
+    """ LRU cache of (translated) MusicIP responses. Cleared whenever MusicIP's cacheid changes. """
+    def __init__(self, maxSize, ttl):
+        self.entries=OrderedDict()
+        self.size=0
+        self.maxSize=maxSize
+        self.ttl=ttl
+        self.cacheId=None
+
+    def ttlFor(self, uri):
+        endpoint=uri.split(b'?')[0].decode("utf-8", "replace").strip('/')
+        return self.ttl[endpoint] if endpoint in self.ttl else 0
+
+    def get(self, uri):
+        if not uri in self.entries:
+            return None
+        expiry, data = self.entries[uri]
+        if expiry<time.monotonic():
+            self.remove(uri)
+            return None
+        self.entries.move_to_end(uri)
+        return data
+
+    def put(self, uri, data):
+        ttl=self.ttlFor(uri)
+        if ttl<=0 or len(data)>self.maxSize:
+            return
+        self.remove(uri)
+        self.entries[uri]=(time.monotonic()+ttl, data)
+        self.size+=len(data)
+        while self.size>self.maxSize:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, uri):
+        if uri in self.entries:
+            self.size-=len(self.entries.pop(uri)[1])
+
+    def setCacheId(self, cacheId):
+        if cacheId!=self.cacheId:
+            if self.cacheId is not None:
+                debug("MusicIP cacheid changed, clearing %d cached response(s)" % len(self.entries))
+            self.entries.clear()
+            self.size=0
+            self.cacheId=cacheId
+
+
+class RequestProducer:
+    """ Registered with each LMS request that a StreamRelay writes to, so that the relay knows which requests are
+        paused. """
+    def __init__(self, relay, request):
+        self.relay=relay
+        self.request=request
+
+    def pauseProducing(self):
+        self.relay.pauseRequest(self.request)
+
+    def resumeProducing(self):
+        self.relay.resumeRequest(self.request)
+
+    def stopProducing(self):
+        self.relay.requestClosed(None, self.request)
+
+
+class StreamRelay(protocol.Protocol):
+    """ Translates a MusicIP response as it arrives and writes it to each LMS request. Data is only translated up to
+        the last newline received, the rest is kept until the next chunk. MusicIP is only read from as quickly as the
+        slowest LMS connection accepts data, and the response is abandoned if no data arrives for 'timeout' seconds. """
+    def __init__(self, response, endpoint, start, backend):
+        self.response=response
+        self.endpoint=endpoint
+        self.backend=backend
+        self.startTime=start
+        self.translateTime=0
+        self.requests=[]
+        self.buffer=b''
+        self.paused=set()
+        self.timer=None
+        self.timedOut=False
+
+    def addRequest(self, request):
+        self.requests.append(request)
+        request.registerProducer(RequestProducer(self, request), True)
+        request.notifyFinish().addErrback(self.requestClosed, request)
+
+    def start(self):
+        """ Called once all waiting requests have been added """
+        self.response.deliverBody(self)
+
+    def connectionMade(self):
+        if len(self.requests)==0:
+            self.transport.stopProducing()
+        else:
+            self.timer=reactor.callLater(config['mip']['timeout'], self.bodyTimedOut)
+
+    def dataReceived(self, data):
+        if self.timer is not None:
+            self.timer.reset(config['mip']['timeout'])
+        self.buffer+=data
+        pos=self.buffer.rfind(b'\n')
+        if pos>=0:
+            self.write(self.translate(self.buffer[:pos+1]))
+            self.buffer=self.buffer[pos+1:]
+
+    def write(self, data):
+        if data:
+            for request in self.requests:
+                request.write(data)
+
+    def translate(self, data):
+        """ Translate a chunk, the total time for all chunks is recorded once the response is complete """
+        start=time.monotonic()
+        data=fixPaths(data, 'mip', 'lms')
+        self.translateTime+=time.monotonic()-start
+        return data
+
+    def bodyTimedOut(self):
+        self.timer=None
+        self.timedOut=True
+        metrics.upstreamError('timeout')
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer=None
+        self.backend.outstanding-=1
+        metrics.upstream.observe(self.endpoint, time.monotonic()-self.startTime-self.translateTime)
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.write(self.translate(self.buffer))
+            metrics.translate.observe(self.endpoint, self.translateTime)
+            for request in self.requests:
+                request.unregisterProducer()
+                request.finish()
+        elif len(self.requests)>0:
+            if self.timedOut:
+                warning("Response from MusicIP timed out")
+            else:
+                warning("Failed to read response from MusicIP - %s" % reason.getErrorMessage())
+            for request in self.requests:
+                request.unregisterProducer()
+                request.loseConnection()
+        self.requests=[]
+        self.paused.clear()
+        self.buffer=b''
+
+    def requestClosed(self, failure, request):
+        if request in self.requests:
+            self.requests.remove(request)
+            if len(self.requests)==0:
+                if self.transport is not None:
+                    self.transport.stopProducing()
+            else:
+                self.resumeRequest(request)
+
+    def pauseRequest(self, request):
+        if request in self.requests and not request in self.paused:
+            self.paused.add(request)
+            if 1==len(self.paused) and self.transport is not None:
+                self.transport.pauseProducing()
+
+    def resumeRequest(self, request):
+        if request in self.paused:
+            self.paused.remove(request)
+            if 0==len(self.paused) and self.transport is not None:
+                self.transport.resumeProducing()
+
+
+class Backend:
+    """ A MusicIP server. Backends are ejected when they fail to respond, and re-admitted once a status check succeeds. """
+    def __init__(self, host, port):
+        self.host=host
+        self.port=int(port)
+        self.name='%s:%d' % (self.host, self.port)
+        self.outstanding=0
+        self.healthy=True
+
+    def failed(self, reason):
+        if self.healthy:
+            warning("MusicIP at %s failed, no longer sending requests to it - %s" % (self.name, reason))
+            self.healthy=False
+
+    def checkStatus(self):
+        url='http://%s/api/getStatus' % self.name
+        d=agent.request(b'GET', url.encode('utf-8'), Headers({'User-Agent': ['mip-proxy']}))
+        d.addCallback(lambda response: readBody(response).addCallback(lambda _: response.code))
+        d.addTimeout(config['mip']['timeout'], reactor)
+        d.addCallbacks(self.statusChecked, lambda f: self.failed(f.getErrorMessage()))
+
+    def statusChecked(self, code):
+        if 200!=code:
+            self.failed("status returned %d" % code)
+        elif not self.healthy:
+            warning("MusicIP at %s is available again" % self.name)
+            self.healthy=True
+
+
+class MixPrecomputer:
+    """ Requests mixes that LMS is likely to ask for next, i.e. those seeded from the last track(s) of a mix that was
+        returned, and keeps these for 'ttl' seconds. Mixes are only requested when no other requests are in progress,
+        and only one at a time. All mixes are dropped when MusicIP's cacheid changes. """
+    def __init__(self, client, seeds, ttl, size):
+        self.client=client
+        self.seeds=seeds
+        self.ttl=ttl
+        self.size=size
+        self.queue=OrderedDict()
+        self.mixes=OrderedDict()
+        self.active=None
+        self.cacheId=None
+
+    def get(self, key):
+        if not key in self.mixes:
+            return None
+        expiry, data = self.mixes[key]
+        if expiry<time.monotonic():
+            del self.mixes[key]
+            return None
+        return data
+
+    def seen(self, uri, data):
+        """ Called with each song mix returned by MusicIP (before paths are translated) """
+        params=uri.split(b'?', 1)[1].split(b'&') if b'?' in uri else []
+        if requestKey(uri)==self.active or not any(p.startswith(b'song=') for p in params):
+            return
+        tracks=[line for line in data.split(b'\n') if line.startswith(b'/')]
+        for track in reversed(tracks[-self.seeds:]):
+            seed=b'song='+quote(track, safe='').encode('utf-8')
+            next=uri.split(b'?', 1)[0]+b'?'+b'&'.join(seed if p.startswith(b'song=') else p for p in params)
+            key=requestKey(next)
+            if key!=self.active and self.get(key) is None:
+                self.queue.pop(key, None)
+                self.queue[key]=next
+        while len(self.queue)>self.size:
+            self.queue.popitem(last=False)
+        self.next()
+
+    def next(self):
+        if self.active is not None or len(self.queue)==0 or any(b.outstanding>0 for b in self.client.backends):
+            return
+        # Most recently seen mixes are the most likely to be wanted next
+        self.active, uri = self.queue.popitem()
+        debug("Precomputing mix '%s'" % uri.decode("utf-8", "replace"))
+        d=self.client.get(uri)
+        d.addCallback(self.store, self.active, self.cacheId)
+        d.addErrback(lambda f: debug("Failed to precompute mix - %s" % f.getErrorMessage()))
+        d.addBoth(self.finished)
+
+    def store(self, result, key, cacheId):
+        # A mix that was requested before the cacheid changed may be out of date
+        if 200==result[0] and isinstance(result[1], bytes) and cacheId==self.cacheId:
+            metrics.precomputed+=1
+            self.mixes.pop(key, None)
+            self.mixes[key]=(time.monotonic()+self.ttl, result[1])
+            while len(self.mixes)>self.size:
+                self.mixes.popitem(last=False)
+
+    def finished(self, _):
+        self.active=None
+        self.next()
+
+    def setCacheId(self, cacheId):
+        if cacheId!=self.cacheId:
+            if self.cacheId is not None:
+                debug("MusicIP cacheid changed, clearing %d precomputed mix(es)" % len(self.mixes))
+            self.mixes.clear()
+            self.queue.clear()
+            self.cacheId=cacheId
+
+
+class MipClient:
+    """ Sends requests to MusicIP. Identical requests that are in progress at the same time share one upstream request.
+        Requests are sent to the healthy backend with the fewest requests outstanding. """
+    def __init__(self, backends):
+        self.inProgress={}
+        self.backends=backends
+        self.next=0
+
+    def backend(self):
+        healthy=[b for b in self.backends if b.healthy]
+        if len(healthy)==0:
+            # Nothing known to be working, so try them all
+            healthy=self.backends
+        # Start from a different backend each time, so that idle backends share requests
+        self.next=(self.next+1)%len(healthy)
+        healthy=healthy[self.next:]+healthy[:self.next]
+        return min(healthy, key=lambda b: b.outstanding)
+
+    def checkBackends(self):
+        for backend in self.backends:
+            backend.checkStatus()
+
+    def get(self, uri):
+        """ Returns a Deferred firing with (code, data) for the (already translated) uri """
+        key=requestKey(uri)
+        if cache is not None:
+            data=cache.get(key)
+            if data is not None:
+                metrics.cacheHits+=1
+                return defer.succeed((200, data))
+            metrics.cacheMisses+=1
+        if precompute is not None:
+            data=precompute.get(key)
+            if data is not None:
+                metrics.precomputeHits+=1
+                return defer.succeed((200, data))
+
+        d=defer.Deferred()
+        if key in self.inProgress:
+            self.inProgress[key].append(d)
+            return d
+
+        self.inProgress[key]=[d]
+        self.send(uri, key, True)
+        return d
+
+    def send(self, uri, key, canRetry):
+        backend=self.backend()
+        url='http://%s%s' % (backend.name, uri.decode("utf-8"))
+        upstream=agent.request(b'GET', url.encode('utf-8'), Headers({'User-Agent': ['mip-proxy']}))
+        endpoint=metrics.endpoint(uri)
+        backend.outstanding+=1
+        upstream.addCallback(self.readResponse, uri, endpoint, time.monotonic(), backend)
+        upstream.addTimeout(config['mip']['timeout'], reactor, onTimeoutCancel=self.timedOut)
+        upstream.addBoth(self.finished, uri, key, backend, canRetry)
+
+    def readResponse(self, response, uri, endpoint, start, backend):
+        if 200!=response.code:
+            metrics.upstreamError(str(response.code))
+        # Large (or unknown length) replies are relayed as they arrive rather than read fully into memory
+        if 200==response.code and config['stream']>0 and (response.length is UNKNOWN_LENGTH or response.length>config['stream']):
+            return (response.code, StreamRelay(response, endpoint, start, backend))
+        d=readBody(response)
+        d.addCallback(self.readBody, uri, response.code, endpoint, start, backend)
+        return d
+
+    def readBody(self, data, uri, code, endpoint, start, backend):
+        backend.outstanding-=1
+        metrics.upstream.observe(endpoint, time.monotonic()-start)
+        if precompute is not None and 200==code and 'api/mix'==endpoint:
+            precompute.seen(uri, data)
+        return (code, translateResponse(data, endpoint) if 200==code else data)
+
+    def timedOut(self, result, timeout):
+        raise defer.TimeoutError()
+
+    def finished(self, result, uri, key, backend, canRetry):
+        if isinstance(result, Failure):
+            backend.outstanding-=1
+            if result.check(defer.TimeoutError):
+                metrics.upstreamError('timeout')
+            else:
+                metrics.upstreamError('failed')
+                backend.failed(result.getErrorMessage())
+                # MusicIP requests do not alter anything, so can be sent to another backend
+                if canRetry and any(b.healthy for b in self.backends):
+                    self.send(uri, key, False)
+                    return
+        if not isinstance(result, Failure) and 200==result[0] and isinstance(result[1], bytes):
+            if uri==CACHEID_URI:
+                if cache is not None:
+                    cache.setCacheId(result[1])
+                if precompute is not None:
+                    precompute.setCacheId(result[1])
+            elif cache is not None:
+                cache.put(key, result[1])
+        for d in self.inProgress.pop(key):
+            # Waiters whose LMS connection was closed will already have been cancelled
+            if not d.called:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+        if not isinstance(result, Failure) and isinstance(result[1], StreamRelay):
+            result[1].start()
+
+    def checkCacheId(self):
+        """ Called periodically, so that cached responses are dropped even if LMS does not ask for the cacheid """
+        self.get(CACHEID_URI).addErrback(lambda _: None)
+
+
 class MipServer(resource.Resource):
     isLeaf = True
+    def __init__(self, client):
+        resource.Resource.__init__(self)
+        self.client=client
+
     def render_GET(self, request):
         global config
+        if request.path==METRICS_PATH:
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+            return metrics.render()
         debug("Request '%s'" % request.uri.decode("utf-8"))
-        try:
-            resp=urllib.request.urlopen('http://%s:%d%s' % (config['mip']['host'], int(config['mip']['port']), fixPaths(request.uri, 'lms', 'mip').decode("utf-8"))).read()
-            return fixPaths(resp, 'mip', 'lms')
-        except urllib.error.HTTPError as e:
-            request.setResponseCode(e.code)
-            return e.read()
+        metrics.inFlight+=1
+        request.notifyFinish().addBoth(self.requestDone, request, metrics.endpoint(request.uri), time.monotonic())
+        d=self.client.get(fixPaths(request.uri, 'lms', 'mip'))
+        d.addCallbacks(self.sendResponse, self.sendError, callbackArgs=(request,), errbackArgs=(request,))
+        # If LMS closes the connection there is no point waiting for MusicIP
+        request.notifyFinish().addErrback(lambda _: d.cancel())
+        return server.NOT_DONE_YET
+
+    def requestDone(self, _, request, endpoint, start):
+        metrics.inFlight-=1
+        metrics.requestDone(endpoint, request.code, time.monotonic()-start, request.sentLength)
+
+    def sendResponse(self, result, request):
+        if not request.finished and not request._disconnected:
+            # Errors from MusicIP are passed back to LMS as-is
+            request.setResponseCode(result[0])
+            if isinstance(result[1], StreamRelay):
+                result[1].addRequest(request)
+            else:
+                request.write(result[1])
+                request.finish()
+
+    def sendError(self, failure, request):
+        if request._disconnected:
+            return
+        if failure.check(defer.TimeoutError):
+            code=504
+            warning("Request to MusicIP timed out '%s'" % request.uri.decode("utf-8"))
+        else:
+            code=502
+            warning("Request to MusicIP failed '%s' - %s" % (request.uri.decode("utf-8"), failure.getErrorMessage()))
+        if not request.finished and not request._disconnected:
+            request.setResponseCode(code)
+            request.finish()
 
 
 def main():
-    global config
+    global config, agent, cache, existence, precompute
     parser = argparse.ArgumentParser(description='MusicIP Proxy')
     parser.add_argument('-c', '--config', type=str, help='Config file (default: config.json)', default='config.json')
     args = parser.parse_args()
@@ -126,14 +804,86 @@ def main():
     except IOError:
         error("Failed to read config file")
  
+    if 'port' in config:
+        port=int(config['port'])
+    if not 'output-format' in config:
+        config['output-format']='mp3'
+    elif not config['output-format'] in OUTPUT_FORMATS:
+        error("Unknown output-format '%s'" % config['output-format'])
     config['types']=[]
     for t in config['transcode']:
-        config['types'].append({'mip':bytes(".%s.mp3" % t, 'utf-8'), 'lms':bytes(".%s" % t, 'utf-8')})
+        for fmt in OUTPUT_FORMATS:
+            config['types'].append({'mip':bytes(".%s.%s" % (t, fmt), 'utf-8'), 'lms':bytes(".%s" % t, 'utf-8'), 'format':fmt})
     config['paths']={'std':{'mip':bytes(config['paths']['mip'].replace('//', '/'), 'utf-8'), 
                             'lms':bytes(config['paths']['lms'].replace('//', '/'), 'utf-8')}}
     config['paths']['enc']={'lms':config['paths']['std']['lms'].replace(bytes('/', 'utf-8'), bytes('%2F', 'utf-8')),
                             'mip':config['paths']['std']['mip'].replace(bytes('/', 'utf-8'), bytes('%2F', 'utf-8'))}
-    srv = server.Site(MipServer())
+    createTranslators()
+    if not 'timeout' in config['mip']:
+        config['mip']['timeout']=30
+    if not 'connections' in config['mip']:
+        config['mip']['connections']=4
+    if not 'check' in config['mip']:
+        config['mip']['check']=10
+    if not 'backends' in config['mip']:
+        config['mip']['backends']=[{'host':config['mip']['host'], 'port':config['mip']['port']}]
+    backends=[Backend(b['host'], b['port']) for b in config['mip']['backends']]
+    metrics.backends=backends
+
+    # Keep connections to MusicIP open, so that requests do not each need a new one
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = config['mip']['connections']
+    agent = Agent(reactor, pool=pool)
+    client = MipClient(backends)
+    if config['mip']['check']>0:
+        task.LoopingCall(client.checkBackends).start(config['mip']['check'])
+
+    if not 'stream' in config:
+        config['stream']=256*1024
+
+    if not 'cache' in config:
+        config['cache']={}
+    if not 'size' in config['cache']:
+        config['cache']['size']=16
+    if not 'check' in config['cache']:
+        config['cache']['check']=60
+    ttl=DEFAULT_CACHE_TTL.copy()
+    if 'ttl' in config['cache']:
+        ttl.update(config['cache']['ttl'])
+    if config['cache']['size']>0:
+        cache = ResponseCache(config['cache']['size']*1024*1024, ttl)
+
+    if not 'exists' in config:
+        config['exists']={}
+    if not 'sample' in config['exists']:
+        config['exists']['sample']=10
+    if not 'ttl' in config['exists']:
+        config['exists']['ttl']=600
+    if not 'size' in config['exists']:
+        config['exists']['size']=10000
+    if not 'report' in config['exists']:
+        config['exists']['report']=300
+    if config['exists']['sample']>0:
+        existence = ExistenceChecker(min(config['exists']['sample'], 100), config['exists']['ttl'], config['exists']['size'])
+        task.LoopingCall(existence.report).start(config['exists']['report'], now=False)
+
+    if not 'precompute' in config:
+        config['precompute']={}
+    if not 'seeds' in config['precompute']:
+        config['precompute']['seeds']=0
+    if not 'ttl' in config['precompute']:
+        config['precompute']['ttl']=600
+    if not 'size' in config['precompute']:
+        config['precompute']['size']=50
+    if config['precompute']['seeds']>0:
+        precompute = MixPrecomputer(client, config['precompute']['seeds'], config['precompute']['ttl'], config['precompute']['size'])
+        # Check for idle backends, as requests that were streamed do not trigger this
+        task.LoopingCall(precompute.next).start(1, now=False)
+
+    if (cache is not None or precompute is not None) and config['cache']['check']>0:
+        task.LoopingCall(client.checkCacheId).start(config['cache']['check'])
+
+    srv = server.Site(MipServer(client))
     debug("Listening on: %d" % port)
     reactor.listenTCP(port, srv)
     reactor.run()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+#
+# Differential test of mip-proxy's path translation against the original
+# chained-replace implementation.
+#
+# Run with: python3 -m unittest test_fixpaths (from the proxy folder)
+#
+
+import importlib.util
+import os
+import random
+import unittest
+from urllib.parse import quote
+
+try:
+    spec=importlib.util.spec_from_file_location('mipproxy', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mip-proxy.py'))
+    proxy=importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(proxy)
+except ImportError:
+    proxy=None
+
+
+def referenceFixPaths(config, data, frm, to):
+    """ The original fixPaths - every rule applied in turn with bytes.replace, cue responses handled line by line. Only
+        changed to handle the output formats (types are listed for each format, but LMS paths are only converted to
+        'output-format'; and the format suffix is only removed from the times of a cue track), and to not check that
+        files exist. """
+    types=[t for t in config['types'] if frm=='mip' or t['format']==config['output-format']]
+    if data:
+        if 'cue' in config and config['cue']:
+            if frm=='mip':
+                resp=[]
+                for line in data.split(b'\n'):
+                    line=line.replace(config['paths']['std'][frm], config['paths']['std'][to])
+                    # /path/file.m4a.CUE_TRACK.start-stop.mp3 -> /path/file.m4a#start-stop
+                    if b'.CUE_TRACK.' in line:
+                        addprefix = False
+                        if line.startswith(b'file '):
+                            line=line[5:].replace(b'.CUE_TRACK.', b'#')
+                            addprefix = True
+                        else:
+                            line=line.replace(b'.CUE_TRACK.', b'#')
+                        parts=line.split(b'#')
+                        for fmt in proxy.OUTPUT_FORMATS:
+                            parts[1]=parts[1].replace(b'.'+fmt.encode(), b'')
+                        line=b'file://'+str.encode(quote(parts[0]))+b'#'+parts[1]
+                        if addprefix:
+                            line=b'file '+line
+                    else:
+                        for t in types:
+                            line=line.replace(t[frm], t[to])
+                    resp.append(line)
+                data=b'\n'.join(resp)
+            else:
+                data=data.replace(config['paths']['enc'][frm], config['paths']['enc'][to])
+                pos=data.find(b'%23')
+                if pos>0:
+                    # Replace file:///path/file.m4a#from-to&param with /path/file.m4a.CUE_TRACK.from-to.mp3&param
+                    suffix=b'.'+config['output-format'].encode()
+                    amp=data.find(b'&', pos)
+                    if amp>0:
+                        data=data[:pos]+b'.CUE_TRACK.'+data[pos+3:amp]+suffix+data[amp:]
+                    else:
+                        data=data[:pos]+b'.CUE_TRACK.'+data[pos+3:]+suffix
+                    data=data.replace(b'file%3A%2F%2F', b'')
+                else:
+                    for t in types:
+                        data=data.replace(t[frm], t[to])
+                data=data.replace(b'%2520', b'%20')
+        else:
+            for t in types:
+                data=data.replace(t[frm], t[to])
+            data=data.replace(config['paths']['std'][frm], config['paths']['std'][to])
+            data=data.replace(config['paths']['enc'][frm], config['paths']['enc'][to])
+    return data
+
+
+def createConfig(lms, mip, transcode, cue, fmt):
+    """ Same as mip-proxy's main() creates from config.json """
+    config={'debug':False, 'cue':cue, 'output-format':fmt, 'types':[]}
+    for t in transcode:
+        for f in proxy.OUTPUT_FORMATS:
+            config['types'].append({'mip':bytes(".%s.%s" % (t, f), 'utf-8'), 'lms':bytes(".%s" % t, 'utf-8'), 'format':f})
+    config['paths']={'std':{'mip':bytes(mip.replace('//', '/'), 'utf-8'), 'lms':bytes(lms.replace('//', '/'), 'utf-8')}}
+    config['paths']['enc']={'lms':config['paths']['std']['lms'].replace(b'/', b'%2F'),
+                            'mip':config['paths']['std']['mip'].replace(b'/', b'%2F')}
+    return config
+
+
+# lms, mip, transcode - including identical and overlapping prefixes, and paths containing extensions or markers
+CONFIGS=[('/lms/', '/mip/', ['m4a']),
+         ('/home/storage/Music/', '/home/craig/MusicIP/', ['m4a', 'ogg']),
+         ('/m/', '/m/', ['m4a']),
+         ('/a.m4a/', '/b/', ['m4a']),
+         ('/x/', '/x/y/', ['m4a', 'm4a.mp3']),
+         ('/p/', '/mp3/', ['mp3']),
+         ('/lms/', '/mip/', []),
+         ('/mip/', '/lms/', ['flac', 'm4a']),
+         ('/CUE/', '/.CUE_TRACK./', ['m4a']),
+         ('/a%2F/', '/b/', ['m4a'])]
+
+# Fragments that random paths, and responses, are built from
+ATOMS=['/lms/', '/mip/', '/m/', '/x/y/', '/a.m4a/', '/b/', '/home/storage/Music/', '/home/craig/MusicIP/', '%2Flms%2F',
+       '%2Fmip%2F', '.m4a', '.m4a.mp3', '.m4a.flac', '.mp3', '.ogg', '.ogg.mp3', '.flac', '.CUE_TRACK.', '10-20',
+       '0-100.5', 'file ', 'active yes', '\n', '%23', '&x=1', 'file%3A%2F%2F', '%2520', 'abc', '/', '%2F', 'é', '#',
+       'mp3', 'x']
+
+CASES=2000
+
+
+@unittest.skipIf(proxy is None, 'twisted is not installed')
+class FixPathsTest(unittest.TestCase):
+    def run(self, result=None):
+        # Restore proxy's config after each test
+        config, translators = proxy.config, proxy.translators
+        try:
+            return super().run(result)
+        finally:
+            proxy.config, proxy.translators = config, translators
+
+    def fixPaths(self, func, data, frm, to):
+        """ Returns translated data, or the type of exception raised """
+        try:
+            return func(data, frm, to)
+        except Exception as e:
+            return type(e)
+
+    def check(self, config, data):
+        for frm, to in [('mip', 'lms'), ('lms', 'mip')]:
+            expected=self.fixPaths(lambda d, f, t: referenceFixPaths(config, d, f, t), data, frm, to)
+            actual=self.fixPaths(proxy.fixPaths, data, frm, to)
+            self.assertEqual(expected, actual, 'config:%s %s->%s data:%s' % (config['paths']['std'], frm, to, data))
+
+    def test_random(self):
+        rand=random.Random(1)
+        for lms, mip, transcode in CONFIGS:
+            for cue in [False, True]:
+                for fmt in proxy.OUTPUT_FORMATS:
+                    config=createConfig(lms, mip, transcode, cue, fmt)
+                    proxy.config, proxy.translators = config, {}
+                    proxy.createTranslators()
+                    for i in range(CASES):
+                        self.check(config, ''.join(rand.choice(ATOMS) for _ in range(rand.randint(0, 12))).encode())
+
+    def test_responses(self):
+        """ Typical MusicIP responses, and LMS requests """
+        for cue in [False, True]:
+            for fmt in proxy.OUTPUT_FORMATS:
+                config=createConfig('/home/storage/Music/', '/home/craig/MusicIP/', ['m4a'], cue, fmt)
+                proxy.config, proxy.translators = config, {}
+                proxy.createTranslators()
+                for data in [b'/home/craig/MusicIP/A/01 x.m4a.mp3\n/home/craig/MusicIP/B/02.flac\n/home/craig/MusicIP/C/03.m4a.flac\n',
+                             b'file /home/craig/MusicIP/A/a.flac.CUE_TRACK.0-100.5.mp3\nactive yes\nfile /home/craig/MusicIP/A/b.m4a.mp3\nactive no\n',
+                             b'/home/craig/MusicIP/A/a.mp3.CUE_TRACK.100.5-200.flac\r\n/home/craig/MusicIP/A/b.mp3\r\n',
+                             b'/api/mix?song=%2Fhome%2Fstorage%2FMusic%2FA%2F01%20x.m4a&size=10',
+                             b'/api/mix?song=file%3A%2F%2F%2Fhome%2Fstorage%2FMusic%2FA%2Fa.flac%2310-20&size=10',
+                             b'/api/mix?song=file%3A%2F%2F%2Fhome%2Fstorage%2FMusic%2FA%2Fa%2520b.flac%230-100.5',
+                             b'']:
+                    self.check(config, data)
+
+    def test_large(self):
+        """ Large responses are translated as a whole, so check many lines at once """
+        rand=random.Random(2)
+        lines=[''.join(rand.choice(ATOMS[:20]) for _ in range(rand.randint(1, 6))) for i in range(5000)]
+        data='\n'.join(lines).encode()
+        for cue in [False, True]:
+            config=createConfig('/lms/', '/mip/', ['m4a'], cue, 'mp3')
+            proxy.config, proxy.translators = config, {}
+            proxy.createTranslators()
+            self.check(config, data)
+
+
+if __name__ == '__main__':
+    unittest.main()